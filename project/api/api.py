@@ -1,4 +1,5 @@
 import os
+import re
 import uuid
 import logging
 import aiofiles
@@ -10,13 +11,18 @@ import aiomysql
 import jwt
 import hashlib
 import secrets
+import mimetypes
+import time
+from email.utils import formatdate, parsedate_to_datetime
 from datetime import datetime, timedelta, timezone
-from fastapi import FastAPI, HTTPException, UploadFile, Form, File, Query, WebSocket, Depends
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, UploadFile, Form, File, Query, WebSocket, Depends, Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import Optional, List
+from collections import deque, defaultdict, OrderedDict
+from contextlib import asynccontextmanager
 from decimal import Decimal
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.websockets import WebSocketDisconnect
@@ -79,6 +85,7 @@ load_dotenv(dotenv_path=env_path)
 JWT_SECRET = os.getenv("JWT_SECRET")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM")
 ACCESS_TOKEN_EXPIRE_HOURS = int(os.getenv("ACCESS_TOKEN_EXPIRE_HOURS"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
 
 security = HTTPBearer()
 
@@ -103,19 +110,111 @@ app = FastAPI()
 # WS_URL = 'ws://tcp.cloudpub.ru:55000/bot'
 UPLOAD_FOLDER = os.path.abspath('uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+STORE_FOLDER = os.path.join(UPLOAD_FOLDER, 'store')  # файлы заказов по SHA-256 содержимого
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(20 * 1024 * 1024)))  # 20 MB, как в боте
+MAX_UPLOAD_BODY = MAX_UPLOAD_SIZE + 64 * 1024  # файл + остальные поля формы и разметка multipart
+FILE_STREAM_CHUNK_SIZE = int(os.getenv("FILE_STREAM_CHUNK_SIZE", str(256 * 1024)))
+ORDER_EVENTS_HISTORY = int(os.getenv("ORDER_EVENTS_HISTORY", "1000"))
+BOT_SHOPS_INVALIDATE_URL = os.getenv("BOT_SHOPS_INVALIDATE_URL")
+BOT_INTERNAL_SECRET = os.getenv("BOT_INTERNAL_SECRET")
+SHOPS_CACHE_SIZE = int(os.getenv("SHOPS_CACHE_SIZE", "256"))
+SHOPS_CACHE_TTL = float(os.getenv("SHOPS_CACHE_TTL", "300"))  # секунды
+SHOPS_VERSION_CHECK_INTERVAL = float(os.getenv("SHOPS_VERSION_CHECK_INTERVAL", "5"))  # секунды
+ORDERS_CURSOR_LAG = float(os.getenv("ORDERS_CURSOR_LAG", "5"))  # секунды
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "200"))
+ORDERS_PAGE_MAX = int(os.getenv("ORDERS_PAGE_MAX", "1000"))
+ORDER_EVENTS_PING_INTERVAL = float(os.getenv("ORDER_EVENTS_PING_INTERVAL", "30"))  # секунды
+FILE_REAPER_INTERVAL = float(os.getenv("FILE_REAPER_INTERVAL", "300"))  # секунды, 0 - очистка выключена
+FILE_REAPER_BATCH = int(os.getenv("FILE_REAPER_BATCH", "100"))
+FILE_REAPER_DRY_RUN = os.getenv("FILE_REAPER_DRY_RUN", "0").lower() in ("1", "true", "yes")
+COMPLETED_FILE_RETENTION = float(os.getenv("COMPLETED_FILE_RETENTION", "0"))  # часы хранения файла после выдачи
+ABANDONED_ORDER_RETENTION = float(os.getenv("ABANDONED_ORDER_RETENTION", "336"))  # часы без изменений до истечения заказа, 0 - не истекают
+PART_FILE_RETENTION = float(os.getenv("PART_FILE_RETENTION", "1"))  # часы хранения недокачанных upload_*.part
 # app.mount("/uploads", StaticFiles(directory=UPLOAD_FOLDER), name="uploads")
 
 
 # Database configuration
-async def get_db():
-    return await aiomysql.connect(
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))  # секунды
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))  # секунды
+
+db_pool: Optional[aiomysql.Pool] = None
+db_pool_waiters = 0
+
+
+@app.on_event("startup")
+async def create_db_pool():
+    """Создание пула соединений с БД на время жизни приложения"""
+    global db_pool
+    db_pool = await aiomysql.create_pool(
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         db=os.getenv("DB_NAME"),
         autocommit=False,
-        cursorclass=aiomysql.DictCursor
+        cursorclass=aiomysql.DictCursor,
+        minsize=DB_POOL_MIN_SIZE,
+        maxsize=DB_POOL_MAX_SIZE,
+        pool_recycle=DB_POOL_RECYCLE
     )
+    logging.info(f"DB pool created: min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}, recycle={DB_POOL_RECYCLE}s")
+
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        db_pool.close()
+        await db_pool.wait_closed()
+        db_pool = None
+        logging.info("DB pool closed")
+
+
+@asynccontextmanager
+async def get_db():
+    """Берет соединение из пула и возвращает его обратно после использования"""
+    global db_pool_waiters
+    db_pool_waiters += 1
+    try:
+        conn = await asyncio.wait_for(db_pool.acquire(), timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.error(f"DB pool acquire timeout ({DB_POOL_ACQUIRE_TIMEOUT}s): {db_pool_stats()}")
+        raise
+    finally:
+        db_pool_waiters -= 1
+
+    try:
+        yield conn
+    finally:
+        try:
+            # Незавершенная транзакция заставила бы пул закрыть соединение
+            if conn.get_transaction_status():
+                await conn.rollback()
+        except Exception as e:
+            logging.error(f"DB connection cleanup error: {str(e)}")
+            conn.close()
+        db_pool.release(conn)
+
+
+def db_pool_stats() -> dict:
+    if db_pool is None:
+        return {"size": 0, "in_use": 0, "idle": 0, "waiters": db_pool_waiters}
+    return {
+        "minsize": db_pool.minsize,
+        "maxsize": db_pool.maxsize,
+        "size": db_pool.size,
+        "in_use": db_pool.size - db_pool.freesize,
+        "idle": db_pool.freesize,
+        "waiters": db_pool_waiters
+    }
+
+
+@app.get("/stats/db_pool")
+async def get_db_pool_stats():
+    """Статистика пула соединений с БД (для подбора размеров пула)"""
+    return db_pool_stats()
 
 
 # @app.websocket("/ws/notify")
@@ -131,7 +230,7 @@ async def get_db():
 # async def notify_bot(order_id: int, status: str):
 #     try:
 #         # Используем существующее подключение через get_db()
-#         async with await get_db() as conn:
+#         async with get_db() as conn:
 #             async with conn.cursor(aiomysql.DictCursor) as cursor:
 #                 await cursor.execute("""
 #                     SELECT o.user_id, o.ID, s.address
@@ -154,7 +253,166 @@ async def get_db():
 #         logging.error(f"WebSocket notification error: {traceback.format_exc()}")
 
 
+# Push-уведомления точек о заказах
+class OrderEventHub:
+    """
+    Рассылка событий по заказам подписанным точкам.
+    Каждое событие получает сквозной номер seq, который клиент использует как курсор
+    при переподключении. Последние события хранятся в кольцевом буфере для повторной отправки.
+    Номера начинаются заново при каждом запуске, поэтому курсор действителен только вместе
+    с epoch - идентификатором запуска процесса.
+    События живут в памяти одного процесса: API запускается одним воркером uvicorn,
+    а клиент на каждом подключении дополнительно делает дельта-синхронизацию GET /orders.
+    """
+
+    def __init__(self, history_size: int):
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.history = deque(maxlen=history_size)
+        self.subscribers = defaultdict(set)
+
+    def publish(self, shop_id: int, event_type: str, order_id: int, status: str):
+        self.seq += 1
+        event = {
+            "type": event_type,
+            "seq": self.seq,
+            "order_id": order_id,
+            "status": status,
+            "ts": datetime.now(timezone.utc).isoformat()
+        }
+        self.history.append((shop_id, event))
+        for queue in list(self.subscribers.get(shop_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Медленный клиент - отправим ему resync вместо потерянных событий
+                queue.overflowed = True
+
+    def subscribe(self, shop_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=ORDER_EVENTS_HISTORY)
+        queue.overflowed = False
+        self.subscribers[shop_id].add(queue)
+        return queue
+
+    def unsubscribe(self, shop_id: int, queue: asyncio.Queue):
+        self.subscribers[shop_id].discard(queue)
+        if not self.subscribers[shop_id]:
+            del self.subscribers[shop_id]
+
+    def replay(self, shop_id: int, since: int, epoch: Optional[str]) -> Optional[list]:
+        """События точки после курсора since или None, если часть событий уже вытеснена из буфера"""
+        if epoch != self.epoch or since > self.seq:
+            # Курсор из прошлого запуска сервера
+            return None
+        oldest = self.history[0][1]["seq"] if self.history else self.seq + 1
+        if since < oldest - 1:
+            return None
+        return [event for event_shop_id, event in self.history
+                if event_shop_id == shop_id and event["seq"] > since]
+
+
+order_events = OrderEventHub(ORDER_EVENTS_HISTORY)
+
+
+async def notify_bot_shops_changed():
+    """Сброс кеша точек в боте после изменения списка точек"""
+    if not BOT_SHOPS_INVALIDATE_URL:
+        return
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+            async with session.post(
+                BOT_SHOPS_INVALIDATE_URL,
+                headers={"X-Bot-Secret": BOT_INTERNAL_SECRET or ""}
+            ) as resp:
+                if resp.status != 200:
+                    logging.warning(f"Bot shop cache invalidation failed: {resp.status}")
+    except Exception as e:
+        logging.warning(f"Bot shop cache invalidation error: {str(e)}")
+
+
 # Helper functions
+class TTLCache:
+    """Ограниченный по размеру LRU-кеш с временем жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self.data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+
+shops_cache = TTLCache(SHOPS_CACHE_SIZE, SHOPS_CACHE_TTL)
+shops_cache_version = None
+shops_version_checked_at = 0.0
+
+
+async def bump_shops_version(cursor):
+    """Увеличивает версию справочника точек в БД (в транзакции изменения точек)"""
+    await cursor.execute(
+        "INSERT INTO cache_version (name, version) VALUES ('shops', 1) "
+        "ON DUPLICATE KEY UPDATE version = version + 1"
+    )
+
+
+async def sync_shops_cache():
+    """
+    Сбрасывает кеш точек, если версия в БД изменилась (точку добавил другой воркер).
+    Версия проверяется не чаще раза в SHOPS_VERSION_CHECK_INTERVAL секунд.
+    """
+    global shops_cache_version, shops_version_checked_at
+    now = time.monotonic()
+    if now - shops_version_checked_at < SHOPS_VERSION_CHECK_INTERVAL:
+        return
+    shops_version_checked_at = now
+    try:
+        async with get_db() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT version FROM cache_version WHERE name = 'shops'")
+                row = await cursor.fetchone()
+                await conn.commit()
+    except Exception as e:
+        logging.warning(f"Shops cache version check failed: {str(e)}")
+        return
+    version = row['version'] if row else 0
+    if version != shops_cache_version:
+        shops_cache.clear()
+        shops_cache_version = version
+
+
+def cached_json_response(request: Request, entry: tuple):
+    """Ответ из кеша (тело, ETag) с поддержкой If-None-Match"""
+    body, etag = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def make_cache_entry(data) -> tuple:
+    body = json.dumps(data, default=decimal_to_float, ensure_ascii=False).encode()
+    return body, f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
 def decimal_to_float(obj):
     if isinstance(obj, Decimal):
         return float(obj)
@@ -179,10 +437,9 @@ async def create_access_token(shop_data: dict) -> str:
     return token
 
 
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> TokenData:
-    """Верификация JWT токена"""
+def decode_access_token(token: str) -> TokenData:
+    """Проверка подписи и срока действия JWT токена"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
 
         shop_id = payload.get("shop_id")
@@ -200,12 +457,36 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+# Проверенные токены: sha256(токен) -> TokenData до истечения срока действия токена.
+# Повторные запросы точки (опрос заказов, скачивание файлов) не проверяют подпись заново
+verified_tokens = TTLCache(TOKEN_CACHE_SIZE, ACCESS_TOKEN_EXPIRE_HOURS * 3600)
+
+
+def get_token_data(token: str) -> TokenData:
+    """decode_access_token с кешем проверенных токенов"""
+    key = hashlib.sha256(token.encode()).digest()
+    token_data = verified_tokens.get(key)
+    if token_data is not None:
+        return token_data
+
+    token_data = decode_access_token(token)
+    ttl = (token_data.exp - datetime.now(timezone.utc)).total_seconds()
+    if ttl > 0:
+        verified_tokens.set(key, token_data, ttl)
+    return token_data
+
+
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> TokenData:
+    """Верификация JWT токена"""
+    return get_token_data(credentials.credentials)
+
+
 # Новые эндпоинты аутентификации
 @app.post("/auth/login")
 async def shop_login(password_hash: str = Form(...)):
     """Аутентификация точки и выдача токена"""
     try:
-        async with await get_db() as conn:
+        async with get_db() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 await cursor.execute(
                     "SELECT ID_shop, name, address FROM shop WHERE password = %s",
@@ -251,33 +532,198 @@ async def verify_token_endpoint(current_shop: TokenData = Depends(verify_token))
 
 
 # Orders endpoints
-@app.get("/orders", response_model=List[dict])
+@app.websocket("/ws/orders")
+async def orders_feed(
+    websocket: WebSocket,
+    since: Optional[int] = Query(None),
+    epoch: Optional[str] = Query(None)
+):
+    """
+    Поток событий order_created / order_status_changed для авторизованной точки.
+    since - номер последнего полученного события, epoch - запуск сервера из hello, в котором
+    этот номер выдан; пропущенные события отправляются сразу.
+    Токен передается в заголовке Authorization: Bearer, а не в адресе, который попадает в лог доступа.
+    Если их уже нет в буфере, отправляется resync и клиент перезагружает список целиком.
+    """
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    try:
+        if scheme.lower() != "bearer" or not token:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        current_shop = get_token_data(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    queue = order_events.subscribe(current_shop.shop_id)
+    receiver = asyncio.create_task(websocket.receive_text())
+    try:
+        if since is not None:
+            missed = order_events.replay(current_shop.shop_id, since, epoch)
+            if missed is None:
+                await websocket.send_json({"type": "resync", "seq": order_events.seq, "epoch": order_events.epoch})
+            else:
+                for event in missed:
+                    await websocket.send_json(event)
+        # hello отправляется последним, чтобы его seq покрывал и пропущенные события
+        await websocket.send_json({"type": "hello", "seq": order_events.seq, "epoch": order_events.epoch})
+
+        while True:
+            getter = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait(
+                {getter, receiver},
+                timeout=ORDER_EVENTS_PING_INTERVAL,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if receiver in done:
+                getter.cancel()
+                # Клиент ничего не присылает, кроме закрытия соединения
+                receiver.result()
+                receiver = asyncio.create_task(websocket.receive_text())
+                continue
+            if getter not in done:
+                getter.cancel()
+                await websocket.send_json({"type": "ping", "seq": order_events.seq, "epoch": order_events.epoch})
+                continue
+            if queue.overflowed:
+                queue.overflowed = False
+                while not queue.empty():
+                    queue.get_nowait()
+                await websocket.send_json({"type": "resync", "seq": order_events.seq, "epoch": order_events.epoch})
+                continue
+            await websocket.send_json(getter.result())
+
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logging.error(f"Orders feed error: {str(e)}")
+    finally:
+        receiver.cancel()
+        order_events.unsubscribe(current_shop.shop_id, queue)
+        if websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+
+def parse_orders_cursor(since: str) -> Optional[datetime]:
+    """Курсор дельта-синхронизации: '0' - начальная загрузка, иначе момент updated_at"""
+    if since in ('', '0'):
+        return None
+    try:
+        return datetime.fromisoformat(since)
+    except ValueError:
+        raise HTTPException(400, detail="Invalid cursor")
+
+
+# Поля заказа, которые можно запросить через fields=. По умолчанию отдаются все,
+# кроме редко нужных: user_id (чат покупателя в Telegram) и updated_at
+ORDER_FIELDS = (
+    'ID', 'ID_shop', 'status', 'color', 'pages', 'price', 'note', 'con_code',
+    'file_path', 'file_extension', 'file_hash', 'color_pages', 'color_page_list',
+    'user_id', 'updated_at'
+)
+ORDER_DEFAULT_FIELDS = ORDER_FIELDS[:-2]
+
+
+def parse_order_fields(fields: Optional[str]) -> str:
+    """Список столбцов для SELECT. ID и status нужны всегда: по ним идут пагинация и дельта"""
+    if not fields:
+        selected = list(ORDER_DEFAULT_FIELDS)
+    else:
+        selected = ['ID', 'status']
+        for field in fields.split(','):
+            field = field.strip()
+            if field not in ORDER_FIELDS:
+                raise HTTPException(400, detail=f"Unknown field: {field}")
+            if field not in selected:
+                selected.append(field)
+    return ", ".join(f"`{field}`" for field in selected)
+
+
+@app.get("/orders")
 async def get_orders(
+    response: Response,
     status: List[str] = Query(..., title="Статусы заказов"),
     shop_id: Optional[int] = Query(None, title="ID магазина"),
+    since: Optional[str] = Query(None, title="Курсор дельта-синхронизации"),
+    after: Optional[int] = Query(None, ge=0, title="ID последнего заказа предыдущей страницы"),
+    limit: int = Query(ORDERS_PAGE_SIZE, ge=1, le=ORDERS_PAGE_MAX, title="Размер страницы"),
+    fields: Optional[str] = Query(None, title="Поля заказа через запятую"),
     current_shop: TokenData = Depends(verify_token)
 ):
-    """Получение заказов для авторизованной точки"""
+    """
+    Получение заказов для авторизованной точки.
+    Без since возвращает страницу списка заказов в указанных статусах по возрастанию ID;
+    если есть следующая страница, ее начало передается в заголовке X-Next-After (параметр after).
+    С since возвращает {"orders", "removed", "cursor"}: заказы, созданные или измененные
+    после курсора, и ID заказов, которые вышли из запрошенных статусов.
+    since=0 - начальная загрузка постранично: next_after в ответе - after следующей страницы,
+    курсором служит cursor первой страницы. Если изменений после курсора больше ORDERS_PAGE_MAX,
+    возвращается {"reset": true} и клиент повторяет начальную загрузку.
+    """
     try:
-        async with await get_db() as conn:
+        cursor_at = parse_orders_cursor(since) if since is not None else None
+        target_shop_id = shop_id if shop_id is not None else current_shop.shop_id
+        columns = parse_order_fields(fields)
+
+        async with get_db() as conn:
             async with conn.cursor() as cursor:
                 placeholders = ",".join(["%s"] * len(status))
-                query = f"SELECT * FROM `order` WHERE status IN ({placeholders})"
-                params = status.copy()
 
-                if shop_id is not None:
-                    query += " AND ID_shop = %s"
-                    params.append(shop_id)
+                if cursor_at is None:
+                    # Keyset-пагинация по индексу (ID_shop, status), который неявно содержит ID
+                    query = (
+                        f"SELECT {columns} FROM `order` WHERE status IN ({placeholders}) AND ID_shop = %s "
+                        f"AND ID > %s ORDER BY ID LIMIT %s"
+                    )
+                    params = status + [target_shop_id, after or 0, limit + 1]
                 else:
-                    # Если shop_id не указан, показываем только заказы текущей точки
-                    query += " AND ID_shop = %s"
-                    params.append(current_shop.shop_id)
+                    # Нестрогое сравнение: строки на границе курсора приходят повторно,
+                    # клиент применяет их идемпотентно по ID
+                    query = f"SELECT {columns} FROM `order` WHERE ID_shop = %s AND updated_at >= %s LIMIT %s"
+                    params = [target_shop_id, cursor_at, ORDERS_PAGE_MAX + 1]
 
                 await cursor.execute(query, params)
                 result = await cursor.fetchall()
+
+                next_after = None
+                if cursor_at is None and len(result) > limit:
+                    result = result[:limit]
+                    next_after = result[-1]['ID']
+
+                if since is None:
+                    await conn.commit()
+                    if next_after is not None:
+                        response.headers["X-Next-After"] = str(next_after)
+                    return result
+
+                await cursor.execute("SELECT NOW(6) AS now")
+                now = (await cursor.fetchone())['now']
                 await conn.commit()
-                return result
 
+        if cursor_at is not None and len(result) > ORDERS_PAGE_MAX:
+            return {"reset": True}
+
+        orders = [row for row in result if row['status'] in status]
+        removed = [row['ID'] for row in result if row['status'] not in status]
+
+        # Курсор отстает от текущего времени, чтобы не потерять строки из транзакций,
+        # которые начались раньше, а зафиксировались после этого запроса
+        next_cursor = now - timedelta(seconds=ORDERS_CURSOR_LAG)
+        if cursor_at is not None:
+            next_cursor = max(next_cursor, cursor_at)
+
+        return {
+            "orders": orders,
+            "removed": removed,
+            "cursor": next_cursor.isoformat(),
+            "next_after": next_after
+        }
+
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error: {traceback.format_exc()}")
         raise HTTPException(500, detail="Server error")
@@ -287,7 +733,7 @@ async def get_orders(
 async def mark_order_ready(order_id: int, current_shop: TokenData = Depends(verify_token)):
     """Пометить заказ как готовый"""
     try:
-        async with await get_db() as conn:
+        async with get_db() as conn:
             async with conn.cursor() as cursor:
                 await conn.begin()
                 # Проверяем что заказ принадлежит точке
@@ -306,6 +752,7 @@ async def mark_order_ready(order_id: int, current_shop: TokenData = Depends(veri
                     (order_id, current_shop.shop_id)
                 )
                 await conn.commit()
+                order_events.publish(current_shop.shop_id, "order_status_changed", order_id, "ready")
                 return {"status": "ready"}
     except Exception as e:
         logging.error(f"Error: {traceback.format_exc()}")
@@ -316,7 +763,7 @@ async def mark_order_ready(order_id: int, current_shop: TokenData = Depends(veri
 async def complete_order(order_id: int, current_shop: TokenData = Depends(verify_token)):
     """Завершить заказ (выдать клиенту)"""
     try:
-        async with await get_db() as conn:
+        async with get_db() as conn:
             async with conn.cursor() as cursor:
                 await conn.begin()
 
@@ -340,29 +787,169 @@ async def complete_order(order_id: int, current_shop: TokenData = Depends(verify
                         detail=f"Невозможно завершить заказ в статусе {current['status']}"
                     )
 
-                file_path = os.path.join(UPLOAD_FOLDER, current['file_path'])
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logging.info(f"Файл заказа {order_id} удален: {file_path}")
-                except Exception as e:
-                    logging.error(f"Ошибка удаления файла: {str(e)}")
-
+                # Файл удаляется фоновой очисткой после срока хранения
                 await cursor.execute(
-                    "UPDATE `order` SET status = 'completed' WHERE ID = %s AND ID_shop = %s",
-                    (order_id, current_shop.shop_id)
+                    "UPDATE `order` SET status = 'completed', file_expires_at = NOW() + INTERVAL %s SECOND "
+                    "WHERE ID = %s AND ID_shop = %s",
+                    (int(COMPLETED_FILE_RETENTION * 3600), order_id, current_shop.shop_id)
                 )
                 await conn.commit()
+                order_events.publish(current_shop.shop_id, "order_status_changed", order_id, "completed")
                 return {"status": "completed"}
 
     except HTTPException:
         raise
     except Exception as e:
-        await conn.rollback()
         logging.error(f"Ошибка завершения заказа: {traceback.format_exc()}")
         raise HTTPException(500, detail="Internal server error")
 
 
+class UploadSizeLimitMiddleware:
+    """
+    Ограничение размера тела загрузки заказа до разбора формы.
+    Starlette принимает multipart-тело целиком (во временный файл) еще до вызова обработчика,
+    поэтому проверка в save_upload_stream срабатывает слишком поздно. Здесь запрос отклоняется
+    сразу по Content-Length, а тело без Content-Length (chunked) обрывается при превышении лимита.
+    """
+
+    def __init__(self, app, path: str, max_size: int):
+        self.app = app
+        self.path = path
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None:
+            try:
+                too_large = int(content_length) > self.max_size
+            except ValueError:
+                response = JSONResponse({"detail": "Invalid Content-Length"}, status_code=400)
+                await response(scope, receive, send)
+                return
+            if too_large:
+                response = JSONResponse({"detail": "File too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_size:
+                    raise HTTPException(413, detail="File too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware, path="/orders", max_size=MAX_UPLOAD_BODY)
+
+
+async def save_upload_stream(file: UploadFile, dest_path: str) -> tuple:
+    """
+    Потоковая запись загруженного файла на диск кусками фиксированного размера.
+    Возвращает (размер, sha256) - хеш считается в том же проходе.
+    """
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(413, detail="File too large")
+
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(dest_path, 'wb') as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(413, detail="File too large")
+                sha256.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+
+    return size, sha256.hexdigest()
+
+
+# Хранилище файлов по содержимому: один файл на SHA-256, сколько бы заказов на него ни ссылалось.
+# order.file_path - имя в хранилище "<sha256><ext>", файл лежит в store/<ab>/<cd>/, чтобы
+# каталоги оставались небольшими. file_store.ref_count - число заказов, чей файл еще не удален.
+# Старые заказы (order_<id><ext>) по-прежнему читаются из корня uploads.
+STORE_NAME = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]{1,10})?$")
+
+
+def store_path(name: str) -> str:
+    return os.path.join(STORE_FOLDER, name[:2], name[2:4], name)
+
+
+def upload_path(name: str) -> str:
+    """Путь к файлу заказа по order.file_path"""
+    if STORE_NAME.match(name):
+        return store_path(name)
+    return os.path.join(UPLOAD_FOLDER, name)
+
+
+async def add_stored_file(cursor, temp_path: str, sha256: str, ext: str, size: int) -> str:
+    """
+    Добавляет ссылку заказа на файл в хранилище (в транзакции создания заказа).
+    Принятый файл перемещается в хранилище или удаляется, если такой уже есть.
+    Возвращает имя в хранилище для order.file_path
+    """
+    ext = ext.lower() if re.fullmatch(r"\.[A-Za-z0-9]{1,10}", ext) else ''
+    await cursor.execute(
+        "INSERT INTO file_store (sha256, ext, size, ref_count) VALUES (%s, %s, %s, 1) "
+        "ON DUPLICATE KEY UPDATE ref_count = ref_count + 1",
+        (sha256, ext, size)
+    )
+    # Расширение берется у первой загрузки: одно содержимое - одно имя
+    await cursor.execute("SELECT ext FROM file_store WHERE sha256 = %s", (sha256,))
+    name = sha256 + (await cursor.fetchone())['ext']
+
+    # Строка file_store заблокирована до конца транзакции, поэтому очистка не может
+    # удалить этот файл между проверкой и перемещением
+    path = store_path(name)
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    return name
+
+
+async def release_order_file(cursor, name: str) -> int:
+    """
+    Снимает ссылку заказа на файл (в транзакции очистки) и удаляет файл, если ссылок
+    больше нет. Возвращает освобожденный объем
+    """
+    match = STORE_NAME.match(name)
+    if not match:
+        return await asyncio.to_thread(remove_file, upload_path(name))
+
+    sha256 = match.group(1)
+    await cursor.execute("SELECT ref_count FROM file_store WHERE sha256 = %s FOR UPDATE", (sha256,))
+    row = await cursor.fetchone()
+    if row is None:
+        return 0
+    if row['ref_count'] > 1:
+        await cursor.execute("UPDATE file_store SET ref_count = ref_count - 1 WHERE sha256 = %s", (sha256,))
+        return 0
+
+    # Файл удаляется под блокировкой строки: загрузка того же содержимого дождется
+    # конца транзакции и положит файл заново
+    await cursor.execute("DELETE FROM file_store WHERE sha256 = %s", (sha256,))
+    return await asyncio.to_thread(remove_file, store_path(name))
+
+
 @app.post("/orders")
 async def create_order(
         file: UploadFile = File(...),
@@ -373,45 +960,61 @@ async def create_order(
         user_id: str = Form(...),
         note: str = Form(''),
         con_code: int = Form(...),
-        file_extension: str = Form(...)
+        file_extension: str = Form(...),
+        color_pages: Optional[int] = Form(None),
+        color_page_list: Optional[str] = Form(None)
 ):
+    if color_pages is not None and not 0 <= color_pages <= pages:
+        raise HTTPException(400, detail="color_pages must be between 0 and pages")
+    if color_page_list is not None and (len(color_page_list) > 1024 or not re.fullmatch(r"[0-9,\-]*", color_page_list)):
+        raise HTTPException(400, detail="Invalid color_page_list")
+
+    temp_path = os.path.join(UPLOAD_FOLDER, f"upload_{uuid.uuid4().hex}.part")
     try:
-        async with await get_db() as conn:
+        # Сначала принимаем файл, чтобы не держать соединение с БД во время загрузки
+        file_size, file_hash = await save_upload_stream(file, temp_path)
+
+        async with get_db() as conn:
             async with conn.cursor() as cursor:
                 # Create order record
                 await cursor.execute("""
                     INSERT INTO `order` (
                         ID_shop, price, note, con_code, color, status, 
-                        user_id, pages, file_extension, file_path
-                    ) VALUES (%s, %s, %s, %s, %s, 'received', %s, %s, %s, 'temp')
+                        user_id, pages, file_extension, file_path,
+                        color_pages, color_page_list
+                    ) VALUES (%s, %s, %s, %s, %s, 'received', %s, %s, %s, 'temp', %s, %s)
                 """, (
                     ID_shop, price, note, con_code, color,
-                    user_id, pages, file_extension
+                    user_id, pages, file_extension,
+                    color_pages, color_page_list
                 ))
                 order_id = cursor.lastrowid
 
-                # Generate filename
-                new_filename = f"order_{order_id}{os.path.splitext(file.filename)[1]}"
-                new_path = os.path.join(UPLOAD_FOLDER, new_filename)
-
-                # Save file
-                async with aiofiles.open(new_path, 'wb') as f:
-                    await f.write(await file.read())
+                # Кладем принятый файл в хранилище (или ссылаемся на уже загруженный такой же)
+                new_filename = await add_stored_file(
+                    cursor, temp_path, file_hash, os.path.splitext(file.filename or '')[1], file_size
+                )
 
                 # Update file path
                 await cursor.execute(
-                    "UPDATE `order` SET file_path = %s WHERE ID = %s",
-                    (new_filename, order_id))
+                    "UPDATE `order` SET file_path = %s, file_hash = %s WHERE ID = %s",
+                    (new_filename, file_hash, order_id))
 
                 await conn.commit()
+                order_events.publish(ID_shop, "order_created", order_id, "received")
+                logging.info(f"Order {order_id} file saved: {new_filename}, {file_size} bytes, sha256={file_hash}")
                 return JSONResponse(
-                    content={"order_id": order_id, "con_code": con_code},
+                    content={"order_id": order_id, "con_code": con_code, "sha256": file_hash},
                     status_code=201
                 )
 
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'new_path' in locals() and os.path.exists(new_path):
-            os.remove(new_path)
+        # Файл, уже перемещенный в хранилище, не удаляем: на него могла сослаться
+        # параллельная загрузка того же содержимого, а без ссылок его переиспользует следующая
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         logging.error(f"Order creation error: {traceback.format_exc()}")
         raise HTTPException(500, detail=str(e))
 
@@ -419,7 +1022,7 @@ async def create_order(
 async def create_shop(shop: ShopCreate):
     """Создание нового магазина (доступно без авторизации для админ-приложения)"""
     try:
-        async with await get_db() as conn:
+        async with get_db() as conn:
             async with conn.cursor() as cursor:
                 # Проверяем уникальность пароля (хеша)
                 await cursor.execute("SELECT ID_shop FROM shop WHERE password = %s", (shop.password,))
@@ -432,8 +1035,12 @@ async def create_shop(shop: ShopCreate):
                     INSERT INTO shop (name, address, w_hours, price_bw, price_cl, password)
                     VALUES (%s, %s, %s, %s, %s, %s)
                 """, (shop.name, shop.address, shop.w_hours, shop.price_bw, shop.price_cl, shop.password))
+                shop_id = cursor.lastrowid
+                await bump_shops_version(cursor)
                 await conn.commit()
-                return {"message": "Shop created successfully", "id": cursor.lastrowid}
+                shops_cache.clear()
+                asyncio.create_task(notify_bot_shops_changed())
+                return {"message": "Shop created successfully", "id": shop_id}
     except HTTPException:
         raise
     except Exception as e:
@@ -442,35 +1049,49 @@ async def create_shop(shop: ShopCreate):
 
 # Shops endpoints
 @app.get("/shops")
-async def get_shops():
+async def get_shops(request: Request):
     """Получение списка магазинов (публичный эндпоинт для бота)"""
     try:
-        async with await get_db() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT name, ID_shop, address FROM shop")
-                shops = await cursor.fetchall()
-                return shops or JSONResponse(
+        await sync_shops_cache()
+        entry = shops_cache.get('list')
+        if entry is None:
+            async with get_db() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("SELECT name, ID_shop, address, w_hours, price_bw, price_cl FROM shop")
+                    shops = await cursor.fetchall()
+                    await conn.commit()
+            if not shops:
+                return JSONResponse(
                     content={"message": "No shops found"},
                     status_code=404
                 )
+            entry = make_cache_entry(shops)
+            shops_cache.set('list', entry)
+        return cached_json_response(request, entry)
     except Exception as e:
         logging.error(f"Error: {traceback.format_exc()}")
         raise HTTPException(500, detail="Server error")
 
 @app.get("/shops/{shop_name}")
-async def get_shop(shop_name: str):
+async def get_shop(shop_name: str, request: Request):
     """Получение информации о магазине (публичный эндпоинт для бота)"""
     try:
-        async with await get_db() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cursor:
-                await cursor.execute(
-                    "SELECT name, ID_shop, address, w_hours, price_bw, price_cl FROM shop WHERE name = %s",
-                    (shop_name,)
-                )
-                shop = await cursor.fetchone()
-                if not shop:
-                    raise HTTPException(status_code=404, detail="Shop not found")
-                return shop
+        await sync_shops_cache()
+        entry = shops_cache.get(f'shop:{shop_name}')
+        if entry is None:
+            async with get_db() as conn:
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute(
+                        "SELECT name, ID_shop, address, w_hours, price_bw, price_cl FROM shop WHERE name = %s",
+                        (shop_name,)
+                    )
+                    shop = await cursor.fetchone()
+                    await conn.commit()
+            if not shop:
+                raise HTTPException(status_code=404, detail="Shop not found")
+            entry = make_cache_entry(shop)
+            shops_cache.set(f'shop:{shop_name}', entry)
+        return cached_json_response(request, entry)
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -482,7 +1103,7 @@ async def get_shop(shop_name: str):
 async def get_shop_by_password(password_hash: str, current_shop: TokenData = Depends(verify_token)):
     """Получение магазина по паролю (только для авторизованных точек)"""
     try:
-        async with await get_db() as conn:
+        async with get_db() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 await cursor.execute(
                     "SELECT ID_shop, name, address FROM shop WHERE password = %s",
@@ -500,21 +1121,334 @@ async def get_shop_by_password(password_hash: str, current_shop: TokenData = Dep
         raise HTTPException(500, detail="Server error")
 
 
+# Фоновая очистка файлов заказов
+file_reaper_stats = {
+    "dry_run": FILE_REAPER_DRY_RUN,
+    "runs": 0,
+    "orders_expired": 0,
+    "files_deleted": 0,
+    "bytes_reclaimed": 0,
+    "errors": 0,
+    "last_run": None
+}
+file_reaper_task: Optional[asyncio.Task] = None
+
+
+def remove_file(path: str) -> int:
+    """Удаляет файл (вызывается в потоке). Возвращает освобожденный объем"""
+    try:
+        size = os.path.getsize(path)
+        if not FILE_REAPER_DRY_RUN:
+            os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def remove_stale_part_files() -> tuple:
+    """Недокачанные загрузки, оставшиеся после обрыва соединения или перезапуска"""
+    deadline = time.time() - PART_FILE_RETENTION * 3600
+    count, size = 0, 0
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            if entry.name.startswith('upload_') and entry.name.endswith('.part') \
+                    and entry.stat().st_mtime < deadline:
+                size += remove_file(entry.path)
+                count += 1
+    return count, size
+
+
+async def expire_abandoned_orders() -> int:
+    """Заказы, которые не меняли статус дольше срока хранения, переводятся в expired"""
+    if ABANDONED_ORDER_RETENTION <= 0:
+        return 0
+
+    async with get_db() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            await cursor.execute(
+                "SELECT ID, ID_shop FROM `order` WHERE status IN ('received', 'ready') "
+                "AND updated_at < NOW() - INTERVAL %s SECOND ORDER BY updated_at LIMIT %s FOR UPDATE",
+                (int(ABANDONED_ORDER_RETENTION * 3600), FILE_REAPER_BATCH)
+            )
+            rows = await cursor.fetchall()
+            if not rows or FILE_REAPER_DRY_RUN:
+                await conn.rollback()
+                if rows:
+                    logging.info(f"File reaper (dry run): would expire orders {[row['ID'] for row in rows]}")
+                return len(rows)
+
+            placeholders = ",".join(["%s"] * len(rows))
+            await cursor.execute(
+                f"UPDATE `order` SET status = 'expired', file_expires_at = NOW() WHERE ID IN ({placeholders})",
+                [row['ID'] for row in rows]
+            )
+            await conn.commit()
+
+    for row in rows:
+        order_events.publish(row['ID_shop'], "order_status_changed", row['ID'], "expired")
+    logging.info(f"File reaper: expired {len(rows)} abandoned orders")
+    return len(rows)
+
+
+async def reap_order_file(row: dict) -> Optional[int]:
+    """
+    Удаляет файл одного заказа (снимает ссылку в хранилище) и пометку. Возвращает освобожденный
+    объем или None, если заказ уже обработала очистка другого воркера
+    """
+    async with get_db() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            # Блокировка строки заказа: ссылка снимается ровно один раз, даже если
+            # ту же пачку выбрали очистки нескольких воркеров
+            await cursor.execute(
+                "SELECT file_path FROM `order` WHERE ID = %s AND file_expires_at IS NOT NULL "
+                "AND file_deleted_at IS NULL FOR UPDATE",
+                (row['ID'],)
+            )
+            current = await cursor.fetchone()
+            if current is None:
+                await conn.rollback()
+                return None
+            reclaimed = await release_order_file(cursor, current['file_path'])
+            if FILE_REAPER_DRY_RUN:
+                await conn.rollback()
+                return reclaimed
+            await cursor.execute(
+                "UPDATE `order` SET file_expires_at = NULL, file_deleted_at = NOW() WHERE ID = %s",
+                (row['ID'],)
+            )
+            await conn.commit()
+    return reclaimed
+
+
+async def delete_marked_files() -> tuple:
+    """
+    Одна пачка файлов, помеченных к удалению (file_expires_at наступил).
+    Возвращает (выбрано заказов, удалено файлов, освобождено байт)
+    """
+    async with get_db() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT ID, file_path FROM `order` WHERE file_expires_at <= NOW() "
+                "ORDER BY file_expires_at LIMIT %s",
+                (FILE_REAPER_BATCH,)
+            )
+            rows = await cursor.fetchall()
+            await conn.commit()
+
+    deleted, reclaimed = [], 0
+    for row in rows:
+        try:
+            size = await reap_order_file(row)
+            if size is not None:
+                reclaimed += size
+                deleted.append(row['ID'])
+        except Exception as e:
+            file_reaper_stats["errors"] += 1
+            logging.error(f"File reaper: failed to delete file of order {row['ID']}: {str(e)}")
+
+    if FILE_REAPER_DRY_RUN and deleted:
+        logging.info(f"File reaper (dry run): would delete files of orders {deleted}, {reclaimed} bytes")
+    return len(rows), len(deleted), reclaimed
+
+
+async def reap_order_files():
+    """Один проход очистки: истечение заброшенных заказов и удаление помеченных файлов"""
+    expired = await expire_abandoned_orders()
+
+    files, reclaimed = 0, 0
+    while True:
+        selected, deleted, size = await delete_marked_files()
+        files += deleted
+        reclaimed += size
+        # В пробном режиме пометки не снимаются - следующая пачка была бы той же
+        if selected < FILE_REAPER_BATCH or deleted < selected or FILE_REAPER_DRY_RUN:
+            break
+
+    part_files, part_size = await asyncio.to_thread(remove_stale_part_files)
+
+    file_reaper_stats["runs"] += 1
+    file_reaper_stats["orders_expired"] += expired
+    file_reaper_stats["files_deleted"] += files + part_files
+    file_reaper_stats["bytes_reclaimed"] += reclaimed + part_size
+    file_reaper_stats["last_run"] = datetime.now(timezone.utc).isoformat()
+    if files or part_files:
+        logging.info(f"File reaper: {files} order files and {part_files} partial uploads, "
+                     f"{reclaimed + part_size} bytes{' (dry run)' if FILE_REAPER_DRY_RUN else ''}")
+
+
+async def file_reaper_loop():
+    while True:
+        try:
+            await reap_order_files()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            file_reaper_stats["errors"] += 1
+            logging.error(f"File reaper error: {traceback.format_exc()}")
+        await asyncio.sleep(FILE_REAPER_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_file_reaper():
+    global file_reaper_task
+    if FILE_REAPER_INTERVAL > 0:
+        file_reaper_task = asyncio.create_task(file_reaper_loop())
+
+
+@app.on_event("shutdown")
+async def stop_file_reaper():
+    global file_reaper_task
+    if file_reaper_task is not None:
+        file_reaper_task.cancel()
+        try:
+            await file_reaper_task
+        except asyncio.CancelledError:
+            pass
+        file_reaper_task = None
+
+
+@app.get("/stats/file_reaper")
+async def get_file_reaper_stats():
+    """Счетчики фоновой очистки файлов"""
+    return file_reaper_stats
+
+
 # Files endpoint
+def parse_range_header(range_header: str, file_size: int) -> Optional[tuple]:
+    """
+    Разбор одиночного диапазона "bytes=start-end" / "bytes=start-" / "bytes=-suffix".
+    Возвращает (start, end) включительно или None, если заголовок нужно проигнорировать.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    start_str, _, end_str = spec.strip().partition('-')
+    try:
+        if start_str == '':
+            suffix = int(end_str)
+            if suffix <= 0:
+                return None
+            start, end = max(file_size - suffix, 0), file_size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        return None
+
+    end = min(end, file_size - 1)
+    if start >= file_size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, end
+
+
+async def iter_file_range(file_path: str, start: int, length: int):
+    async with aiofiles.open(file_path, 'rb') as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(FILE_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Слабое сравнение ETag для If-None-Match"""
+    if if_none_match.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+def not_modified_since(if_modified_since: str, mtime: float) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # Last-Modified передается с точностью до секунды
+    return int(mtime) <= since.timestamp()
+
+
+def file_response(request: Request, file_path: str, file_hash: Optional[str] = None):
+    """
+    Отдача файла с валидаторами кеша: 304 на условные запросы (If-None-Match / If-Modified-Since),
+    диапазон байт (Range / If-Range) для докачки, иначе файл целиком.
+    """
+    stat = os.stat(file_path)
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    # Сильный ETag по хешу содержимого, для старых заказов без хеша - слабый по mtime и размеру
+    etag = f'"{file_hash}"' if file_hash else f'W/"{int(stat.st_mtime)}-{stat.st_size}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Last-Modified": last_modified,
+        "ETag": etag,
+        "Cache-Control": "private, no-cache"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since is not None and not_modified_since(if_modified_since, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range допускает только сильный ETag или точную дату изменения
+    if_range_ok = if_range is None or if_range == last_modified or (
+        if_range == etag and not etag.startswith('W/')
+    )
+    # Если файл изменился с момента начала загрузки (If-Range не совпал), отдаем его целиком
+    if range_header and if_range_ok:
+        byte_range = parse_range_header(range_header, stat.st_size)
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                iter_file_range(file_path, start, end - start + 1),
+                status_code=206,
+                headers=headers,
+                media_type=mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+            )
+
+    return FileResponse(file_path, headers=headers, stat_result=stat)
+
+
 @app.get("/files/{filename}")
 async def get_file(
         filename: str,
+        request: Request,
         current_shop: TokenData = Depends(verify_token)
 ):
     """Защищенный доступ к файлам - только для авторизованных точек"""
     try:
         # Проверяем, принадлежит ли файл заказа текущей точке
-        async with await get_db() as conn:
+        async with get_db() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
+                # Один файл хранилища может принадлежать нескольким заказам точки
                 await cursor.execute("""
-                    SELECT o.ID_shop 
+                    SELECT o.ID_shop, o.file_hash 
                     FROM `order` o 
-                    WHERE o.file_path = %s AND o.ID_shop = %s
+                    WHERE o.file_path = %s AND o.ID_shop = %s AND o.file_deleted_at IS NULL
+                    LIMIT 1
                 """, (filename, current_shop.shop_id))
                 order = await cursor.fetchone()
 
@@ -524,11 +1458,11 @@ async def get_file(
                         detail="Access denied - file does not belong to your shop"
                     )
 
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
+        file_path = upload_path(filename)
         if not os.path.exists(file_path):
             raise HTTPException(404, detail="File not found")
 
-        return FileResponse(file_path)
+        return file_response(request, file_path, order['file_hash'])
 
     except HTTPException:
         raise
@@ -0,0 +1,45 @@
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+# Микробенчмарк стоимости авторизации одного запроса: полная проверка JWT
+# против кеша проверенных токенов. Запуск: python auth_benchmark.py [кол-во запросов]
+
+os.environ.setdefault("JWT_SECRET", "benchmark-secret")
+os.environ.setdefault("JWT_ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_HOURS", "12")
+
+import jwt
+import api
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    token = jwt.encode(
+        {
+            "shop_id": 1,
+            "shop_name": "benchmark",
+            "exp": datetime.now(timezone.utc) + timedelta(hours=1),
+            "iat": datetime.now(timezone.utc),
+            "type": "access"
+        },
+        api.JWT_SECRET,
+        algorithm=api.JWT_ALGORITHM
+    )
+
+    api.verified_tokens.clear()
+    api.get_token_data(token)
+
+    uncached = timeit.timeit(lambda: api.decode_access_token(token), number=number)
+    cached = timeit.timeit(lambda: api.get_token_data(token), number=number)
+
+    print(f"Запросов: {number}")
+    print(f"Проверка подписи JWT: {uncached / number * 1e6:.2f} мкс/запрос")
+    print(f"Кеш проверенных токенов: {cached / number * 1e6:.2f} мкс/запрос")
+    print(f"Ускорение: x{uncached / cached:.1f}")
+
+
+if __name__ == "__main__":
+    main()
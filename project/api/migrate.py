@@ -0,0 +1,188 @@
+import os
+import re
+import sys
+import asyncio
+import argparse
+import logging
+import aiomysql
+from dotenv import load_dotenv
+
+# Версионные миграции схемы БД и проверка планов частых запросов API.
+#   python migrate.py            - применить новые миграции
+#   python migrate.py status     - список миграций и их состояние
+#   python migrate.py baseline N - отметить миграции до N включительно как примененные
+#                                  (для БД, где схема создавалась вручную)
+#   python migrate.py check      - EXPLAIN частых запросов, код возврата 1 при полном сканировании
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_NAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+env_path = os.path.join(os.path.dirname(__file__), 'config.env')
+load_dotenv(dotenv_path=env_path)
+
+# (обработчик в api.py, запрос, пример параметров)
+HOT_QUERIES = [
+    ("get_orders",
+     "SELECT ID, status FROM `order` WHERE status IN (%s, %s) AND ID_shop = %s AND ID > %s ORDER BY ID LIMIT %s",
+     ('received', 'ready', 1, 0, 201)),
+    ("get_orders (since)",
+     "SELECT ID, status FROM `order` WHERE ID_shop = %s AND updated_at >= %s LIMIT %s",
+     (1, '2000-01-01 00:00:00', 1001)),
+    ("mark_order_ready / complete_order",
+     "SELECT status, user_id, file_path FROM `order` WHERE ID = %s AND ID_shop = %s",
+     (1, 1)),
+    ("get_file",
+     "SELECT o.ID_shop, o.file_hash FROM `order` o "
+     "WHERE o.file_path = %s AND o.ID_shop = %s AND o.file_deleted_at IS NULL LIMIT 1",
+     ('0' * 64 + '.pdf', 1)),
+    ("expire_abandoned_orders",
+     "SELECT ID, ID_shop FROM `order` WHERE status IN ('received', 'ready') "
+     "AND updated_at < NOW() - INTERVAL %s SECOND ORDER BY updated_at LIMIT %s",
+     (1209600, 100)),
+    ("delete_marked_files",
+     "SELECT ID, file_path FROM `order` WHERE file_expires_at <= NOW() ORDER BY file_expires_at LIMIT %s",
+     (100,)),
+    ("shop_login / get_shop_by_password",
+     "SELECT ID_shop, name, address FROM shop WHERE password = %s",
+     ('0' * 64,)),
+    ("get_shop",
+     "SELECT name, ID_shop, address, w_hours, price_bw, price_cl FROM shop WHERE name = %s",
+     ('',)),
+]
+
+
+def load_migrations() -> list:
+    """Файлы миграций по возрастанию версии: (версия, имя, путь)"""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_NAME.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Повторяющиеся номера миграций")
+    return migrations
+
+
+def split_statements(sql: str) -> list:
+    """Отдельные SQL-выражения файла миграции (без комментариев)"""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+async def connect():
+    return await aiomysql.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        db=os.getenv("DB_NAME"),
+        autocommit=True,
+        cursorclass=aiomysql.DictCursor
+    )
+
+
+async def applied_versions(cursor) -> set:
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        )
+    """)
+    await cursor.execute("SELECT version FROM schema_migrations")
+    return {row['version'] for row in await cursor.fetchall()}
+
+
+async def migrate(cursor):
+    applied = await applied_versions(cursor)
+    pending = [m for m in load_migrations() if m[0] not in applied]
+    if not pending:
+        logging.info("Схема БД актуальна")
+        return
+
+    for version, name, path in pending:
+        with open(path, 'r', encoding='utf-8') as f:
+            statements = split_statements(f.read())
+        # DDL в MySQL не откатывается транзакцией, поэтому миграция отмечается
+        # только после успешного выполнения всех ее выражений
+        logging.info(f"Применение миграции {version:03d}_{name}")
+        for statement in statements:
+            await cursor.execute(statement)
+        await cursor.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name)
+        )
+    logging.info(f"Применено миграций: {len(pending)}")
+
+
+async def status(cursor):
+    applied = await applied_versions(cursor)
+    for version, name, _ in load_migrations():
+        mark = 'x' if version in applied else ' '
+        print(f"[{mark}] {version:03d}_{name}")
+
+
+async def baseline(cursor, up_to: int):
+    applied = await applied_versions(cursor)
+    for version, name, _ in load_migrations():
+        if version <= up_to and version not in applied:
+            await cursor.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name)
+            )
+            logging.info(f"Миграция {version:03d}_{name} отмечена как примененная")
+
+
+async def check(cursor) -> bool:
+    """
+    EXPLAIN частых запросов. Ошибка - таблица читается целиком без подходящего индекса.
+    Если индекс есть, но оптимизатор выбрал полное сканирование (так бывает на почти
+    пустых таблицах), выводится предупреждение.
+    """
+    ok = True
+    for handler, query, params in HOT_QUERIES:
+        await cursor.execute("EXPLAIN " + query, params)
+        for row in await cursor.fetchall():
+            full_scan = row['type'] in ('ALL', 'index')
+            if full_scan and not row['possible_keys']:
+                ok = False
+                level = 'FAIL'
+            elif full_scan:
+                level = 'WARN'
+            else:
+                level = 'OK'
+            print(f"{level:4} {handler}: table={row['table']} type={row['type']} "
+                  f"key={row['key']} possible_keys={row['possible_keys']} rows={row['rows']}")
+    return ok
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Миграции схемы БД send-to-print")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('up', help="применить новые миграции")
+    subparsers.add_parser('status', help="состояние миграций")
+    baseline_parser = subparsers.add_parser('baseline', help="отметить миграции как примененные")
+    baseline_parser.add_argument('version', type=int)
+    subparsers.add_parser('check', help="EXPLAIN частых запросов")
+    args = parser.parse_args()
+
+    conn = await connect()
+    try:
+        async with conn.cursor() as cursor:
+            if args.command == 'status':
+                await status(cursor)
+            elif args.command == 'baseline':
+                await baseline(cursor, args.version)
+            elif args.command == 'check':
+                return 0 if await check(cursor) else 1
+            else:
+                await migrate(cursor)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    sys.exit(asyncio.run(main()))
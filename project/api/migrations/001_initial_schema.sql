@@ -0,0 +1,30 @@
+-- Исходная схема точек печати и заказов (до введения миграций).
+-- На существующей БД эту и уже примененные вручную миграции отмечают командой
+-- python migrate.py baseline <версия>
+
+CREATE TABLE IF NOT EXISTS shop (
+    ID_shop INT NOT NULL AUTO_INCREMENT,
+    name VARCHAR(255) NOT NULL,
+    address VARCHAR(255) NOT NULL,
+    w_hours VARCHAR(255) NOT NULL,
+    price_bw DECIMAL(10, 2) NOT NULL,
+    price_cl DECIMAL(10, 2) NOT NULL,
+    password CHAR(64) NOT NULL,
+    PRIMARY KEY (ID_shop)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `order` (
+    ID INT NOT NULL AUTO_INCREMENT,
+    ID_shop INT NOT NULL,
+    price DECIMAL(10, 2) NOT NULL,
+    note VARCHAR(255) NOT NULL DEFAULT '',
+    con_code INT NOT NULL,
+    color VARCHAR(32) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'received',
+    user_id VARCHAR(32) NOT NULL,
+    pages INT NOT NULL,
+    file_extension VARCHAR(10) NOT NULL,
+    file_path VARCHAR(255) NOT NULL,
+    PRIMARY KEY (ID),
+    CONSTRAINT fk_order_shop FOREIGN KEY (ID_shop) REFERENCES shop (ID_shop)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
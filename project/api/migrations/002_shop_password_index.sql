@@ -0,0 +1,4 @@
+-- Индекс для входа точки по хешу пароля (POST /auth/login, GET /shop/{password_hash}).
+-- Без него каждый вход читает всю таблицу shop.
+-- В password хранится SHA-256 в hex - 64 символа.
+CREATE INDEX idx_shop_password ON shop (password(64));
@@ -0,0 +1,12 @@
+-- Хеш файла заказа (ETag при скачивании), время изменения для дельта-синхронизации
+-- GET /orders?since и версия справочника точек для кеша /shops
+
+ALTER TABLE `order`
+    ADD COLUMN file_hash CHAR(64) NULL,
+    ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);
+
+CREATE TABLE IF NOT EXISTS cache_version (
+    name VARCHAR(64) NOT NULL,
+    version BIGINT NOT NULL,
+    PRIMARY KEY (name)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,5 @@
+-- Количество и номера цветных страниц для печати "цветная только где нужно"
+
+ALTER TABLE `order`
+    ADD COLUMN color_pages INT NULL,
+    ADD COLUMN color_page_list VARCHAR(1024) NULL;
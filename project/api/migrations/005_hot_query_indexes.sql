@@ -0,0 +1,14 @@
+-- Индексы под частые запросы API. Вторичные индексы InnoDB неявно содержат ID,
+-- поэтому (ID_shop, status) покрывает и сортировку заказов точки по ID.
+
+-- get_orders: WHERE status IN (...) AND ID_shop = ?
+CREATE INDEX idx_order_shop_status ON `order` (ID_shop, status);
+
+-- get_orders с since: WHERE ID_shop = ? AND updated_at >= ?
+CREATE INDEX idx_order_shop_updated ON `order` (ID_shop, updated_at);
+
+-- get_file: WHERE file_path = ? AND ID_shop = ?
+CREATE INDEX idx_order_file_path_shop ON `order` (file_path, ID_shop);
+
+-- get_shop: WHERE name = ?
+CREATE INDEX idx_shop_name ON shop (name);
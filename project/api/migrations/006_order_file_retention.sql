@@ -0,0 +1,16 @@
+-- Отложенное удаление файлов заказов фоновой очисткой API.
+-- file_expires_at - когда файл можно удалить (помечает complete_order и истечение заказа),
+-- file_deleted_at - когда файл был удален.
+
+ALTER TABLE `order`
+    ADD COLUMN file_expires_at DATETIME NULL,
+    ADD COLUMN file_deleted_at DATETIME NULL;
+
+-- Очистка: WHERE file_expires_at <= NOW()
+CREATE INDEX idx_order_file_expires ON `order` (file_expires_at);
+
+-- Истечение заброшенных заказов: WHERE status IN ('received', 'ready') AND updated_at < ?
+CREATE INDEX idx_order_status_updated ON `order` (status, updated_at);
+
+-- Раньше файлы выданных заказов удалялись сразу при выдаче
+UPDATE `order` SET file_deleted_at = updated_at WHERE status = 'completed';
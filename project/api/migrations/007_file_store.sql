@@ -0,0 +1,11 @@
+-- Хранилище файлов заказов по SHA-256 содержимого: одинаковые файлы хранятся один раз.
+-- ref_count - число заказов, ссылающихся на файл, чей файл еще не удален очисткой.
+
+CREATE TABLE IF NOT EXISTS file_store (
+    sha256 CHAR(64) NOT NULL,
+    ext VARCHAR(11) NOT NULL,
+    size BIGINT NOT NULL,
+    ref_count INT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (sha256)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -8,22 +8,29 @@ import json
 import websockets
 import uuid
 import traceback
+import hashlib
+import heapq
+import time
+import queue
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from collections import OrderedDict
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.enums import ContentType
-from PyPDF2 import PdfReader
-from io import BytesIO
 from aiohttp import web
-import pythoncom
-import win32com.client
 import tempfile
-import zipfile
-import xml.dom.minidom
 import docx
 from dotenv import load_dotenv
+from page_count import count_pages, detect_color_pages, report_worker_pid
+from fsm_storage import create_storage
+from doc_converter import DocConverterPool, ConverterBusyError
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -38,6 +45,39 @@ API_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 API_URL = os.getenv("API_URL")
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+MAX_FILE_SIZE = 20 * 1024 * 1024  # ограничение Telegram Bot API на скачивание файлов
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))  # секунды
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # секунды
+SHOP_CACHE_TTL = float(os.getenv("SHOP_CACHE_TTL", "300"))  # секунды
+SHOP_CACHE_STALE_TTL = float(os.getenv("SHOP_CACHE_STALE_TTL", "3600"))  # секунды
+BOT_HTTP_HOST = os.getenv("BOT_HTTP_HOST", "0.0.0.0")
+BOT_HTTP_PORT = os.getenv("BOT_HTTP_PORT")
+BOT_INTERNAL_SECRET = os.getenv("BOT_INTERNAL_SECRET")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, по которому Telegram достучится до BOT_HTTP_PORT
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "32"))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # memory | sqlite | mysql
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_fsm.sqlite3'))
+ORDER_TIMEOUT = 600  # секунды на оформление заказа
+CONFIRMATION_TIMEOUT = 60  # секунды на подтверждение заказа
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "5000"))
+ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH")  # файл для сохранения кеша между запусками (необязательно)
+PAGE_COUNT_WORKERS = int(os.getenv("PAGE_COUNT_WORKERS", "2"))
+PAGE_COUNT_MAX_QUEUE = int(os.getenv("PAGE_COUNT_MAX_QUEUE", "8"))
+PAGE_COUNT_TIMEOUT = float(os.getenv("PAGE_COUNT_TIMEOUT", "30"))  # секунды
+COLOR_DETECT_WORKERS = int(os.getenv("COLOR_DETECT_WORKERS", "1"))
+COLOR_DETECT_MAX_QUEUE = int(os.getenv("COLOR_DETECT_MAX_QUEUE", "4"))
+COLOR_DETECT_TIMEOUT = float(os.getenv("COLOR_DETECT_TIMEOUT", "15"))  # секунды
+COLOR_DETECT_MAX_PAGES = int(os.getenv("COLOR_DETECT_MAX_PAGES", "200"))  # длиннее - без поиска цветных страниц
+DOC_CONVERTER_BINARY = os.getenv("DOC_CONVERTER_BINARY", "soffice")
+DOC_CONVERTER_WORKERS = int(os.getenv("DOC_CONVERTER_WORKERS", "2"))
+DOC_CONVERTER_MAX_QUEUE = int(os.getenv("DOC_CONVERTER_MAX_QUEUE", "8"))
+DOC_CONVERTER_TIMEOUT = float(os.getenv("DOC_CONVERTER_TIMEOUT", "60"))  # секунды
+DOC_CONVERTER_PROFILES = os.getenv("DOC_CONVERTER_PROFILES", os.path.join(tempfile.gettempdir(), 'send_to_print_lo'))
 
 
 class Form(StatesGroup):
@@ -48,10 +88,443 @@ class Form(StatesGroup):
     confirmation = State()
 
 
+class PoolBusyError(Exception):
+    """Пул обработки файлов занят, пользователю нужно повторить попытку позже"""
+
+
+class WorkerPool:
+    """
+    Пул процессов для тяжелого анализа файлов вне event loop бота.
+    Одновременно принимается не больше workers + max_queue задач, лишние сразу
+    получают PoolBusyError. В исполнитель передается не больше workers задач,
+    поэтому timeout отсчитывается от начала выполнения, а не от постановки в очередь.
+    Процесс нельзя прервать посреди задачи, поэтому при превышении timeout пул
+    пересоздается; задачи, оборвавшиеся вместе со старым пулом, повторяются один раз.
+    """
+
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self.slots = None
+        self.executor = None
+        self.worker_pids = None
+
+    def start(self):
+        self.slots = asyncio.Semaphore(self.workers)
+        self.executor = self._create_executor()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Процессы пула сообщают свои PID через отдельную очередь каждого исполнителя
+        self.worker_pids = multiprocessing.Queue()
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=report_worker_pid,
+            initargs=(self.worker_pids,)
+        )
+
+    async def run(self, func, *args):
+        if self.pending >= self.capacity:
+            raise PoolBusyError()
+
+        self.pending += 1
+        try:
+            async with self.slots:
+                for attempt in range(2):
+                    executor = self.executor
+                    future = asyncio.get_running_loop().run_in_executor(executor, func, *args)
+                    future.add_done_callback(self._consume_exception)
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+                    except asyncio.TimeoutError:
+                        self._recycle(executor)
+                        raise
+                    except BrokenProcessPool:
+                        # Пул пересоздан из-за чужой задачи или процесс аварийно завершился
+                        if executor is self.executor:
+                            self._recycle(executor)
+                        logging.warning(f"Задача пула процессов прервана, попытка {attempt + 1}")
+                raise PoolBusyError()
+        finally:
+            self.pending -= 1
+
+    @staticmethod
+    def _consume_exception(future: asyncio.Future):
+        if not future.cancelled():
+            # После тайм-аута результат никто не ждет - забираем ошибку, чтобы не засорять лог
+            future.exception()
+
+    def _recycle(self, executor: ProcessPoolExecutor):
+        """Завершает процессы зависшего пула и запускает новый"""
+        if executor is not self.executor:
+            # Пул уже пересоздан по тайм-ауту другой задачи
+            return
+        logging.warning("Пул процессов пересоздается")
+        pids = []
+        while True:
+            try:
+                pids.append(self.worker_pids.get_nowait())
+            except queue.Empty:
+                break
+        executor.shutdown(wait=False, cancel_futures=True)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                # Процесс уже завершился
+                pass
+        self.worker_pids.close()
+        self.executor = self._create_executor()
+
+
+class AnalysisCache:
+    """
+    LRU-кеш результатов анализа файлов (страницы, формат, цветность) по file_unique_id
+    Telegram и по SHA-256 содержимого. Повторно присланный файл не скачивается и не анализируется.
+    """
+
+    def __init__(self, maxsize: int, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self.path = path
+        self.records = OrderedDict()
+
+    def get(self, key: str) -> Optional[dict]:
+        record = self.records.get(key)
+        if record is not None:
+            self.records.move_to_end(key)
+        return record
+
+    def put(self, keys, record: dict):
+        for key in keys:
+            self.records[key] = record
+            self.records.move_to_end(key)
+        while len(self.records) > self.maxsize:
+            self.records.popitem(last=False)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.records = OrderedDict(json.load(f))
+            logging.info(f"Загружен кеш анализа файлов: {len(self.records)} записей")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки кеша анализа файлов: {str(e)}")
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.records, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения кеша анализа файлов: {str(e)}")
+
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_PATH)
+
+
+page_count_pool = WorkerPool(PAGE_COUNT_WORKERS, PAGE_COUNT_MAX_QUEUE, PAGE_COUNT_TIMEOUT)
+# Поиск цветных страниц растеризует весь документ - отдельный пул, чтобы он не задерживал подсчет страниц
+color_detect_pool = WorkerPool(COLOR_DETECT_WORKERS, COLOR_DETECT_MAX_QUEUE, COLOR_DETECT_TIMEOUT)
+
+
+doc_converter = DocConverterPool(
+    DOC_CONVERTER_BINARY, DOC_CONVERTER_WORKERS, DOC_CONVERTER_MAX_QUEUE,
+    DOC_CONVERTER_TIMEOUT, DOC_CONVERTER_PROFILES
+)
+exact_page_jobs = {}  # sha256 -> задача точного подсчета страниц DOC/DOCX
+
+
+# Долгоживущие HTTP-сессии с пулами keep-alive соединений к API и к файловому хосту Telegram
+api_session: Optional[aiohttp.ClientSession] = None
+telegram_session: Optional[aiohttp.ClientSession] = None
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        connector=aiohttp.TCPConnector(
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+    )
+
+
+async def init_http_sessions():
+    global api_session, telegram_session
+    api_session = create_http_session()
+    telegram_session = create_http_session()
+
+
+async def close_http_sessions():
+    global api_session, telegram_session
+    for session in (api_session, telegram_session):
+        if session is not None and not session.closed:
+            await session.close()
+    api_session = telegram_session = None
+
+
+class ShopCache:
+    """
+    Кеш справочника точек печати по ID и по названию.
+    В течение ttl данные отдаются без запросов к API; после ttl, но до ttl + stale_ttl
+    отдаются устаревшие данные и параллельно запускается обновление; позже - ждем обновления.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.shops = None
+        self.by_id = {}
+        self.by_name = {}
+        self.loaded_at = 0.0
+        self.etag = None
+        self.lock = asyncio.Lock()
+        self.refresh_task = None
+
+    async def get_all(self) -> list:
+        age = time.monotonic() - self.loaded_at
+        if self.shops is None or age > self.ttl + self.stale_ttl:
+            await self.refresh()
+        elif age > self.ttl:
+            self.refresh_in_background()
+        return self.shops
+
+    async def get_by_name(self, name: str) -> Optional[dict]:
+        await self.get_all()
+        return self.by_name.get(name)
+
+    async def get_by_id(self, shop_id: int) -> Optional[dict]:
+        await self.get_all()
+        return self.by_id.get(shop_id)
+
+    def refresh_in_background(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.refresh())
+
+    def invalidate(self):
+        """Сброс кеша: данные считаются устаревшими и сразу перезапрашиваются"""
+        self.loaded_at = 0.0
+        if self.shops is not None:
+            self.refresh_in_background()
+
+    async def refresh(self):
+        async with self.lock:
+            # Пока ждали блокировку, кеш мог обновить другой обработчик
+            if self.shops is not None and time.monotonic() - self.loaded_at <= self.ttl:
+                return
+            # Если список не менялся, API ответит 304 без тела
+            headers = {'If-None-Match': self.etag} if self.etag and self.shops is not None else {}
+            try:
+                async with api_session.get(f"{API_URL}/shops", headers=headers) as resp:
+                    if resp.status == 304:
+                        self.loaded_at = time.monotonic()
+                        return
+                    if resp.status == 404:
+                        shops = []
+                    elif resp.status != 200:
+                        raise ValueError(f"Ошибка HTTP {resp.status}")
+                    else:
+                        shops = await resp.json()
+                        self.etag = resp.headers.get('ETag')
+            except Exception as e:
+                logging.error(f"Ошибка обновления списка точек: {str(e)}")
+                # Устаревшие данные лучше, чем никаких
+                if self.shops is None:
+                    raise
+                return
+
+            self.shops = shops
+            self.by_id = {shop['ID_shop']: shop for shop in shops}
+            self.by_name = {shop['name']: shop for shop in shops}
+            self.loaded_at = time.monotonic()
+            logging.info(f"Список точек обновлен: {len(shops)}")
+
+
+shop_cache = ShopCache(SHOP_CACHE_TTL, SHOP_CACHE_STALE_TTL)
+
+
+async def handle_shops_invalidate(request: web.Request) -> web.Response:
+    """Хук для API: список точек изменился"""
+    if not BOT_INTERNAL_SECRET or request.headers.get('X-Bot-Secret') != BOT_INTERNAL_SECRET:
+        return web.json_response({"detail": "Forbidden"}, status=403)
+    shop_cache.invalidate()
+    return web.json_response({"status": "ok"})
+
+
+webhook_semaphore = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENCY)
+webhook_tasks = set()
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    """
+    Прием обновлений от Telegram в режиме webhook. Ответ отдается сразу,
+    обновление обрабатывается в фоне, одновременно - не больше WEBHOOK_MAX_CONCURRENCY.
+    Для локальной проверки достаточно отправить сюда POST с JSON записанного обновления.
+    """
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.json_response({"detail": "Forbidden"}, status=403)
+    try:
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        logging.warning(f"Некорректное обновление в webhook: {str(e)}")
+        return web.json_response({"detail": "Invalid update"}, status=400)
+
+    task = asyncio.create_task(process_webhook_update(update))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return web.json_response({"ok": True})
+
+
+async def process_webhook_update(update: types.Update):
+    async with webhook_semaphore:
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            logging.error(f"Ошибка обработки обновления {update.update_id}: {traceback.format_exc()}")
+
+
+bot_http_runner: Optional[web.AppRunner] = None
+
+
+async def start_bot_http_server():
+    global bot_http_runner
+    if not BOT_HTTP_PORT:
+        return
+    app = web.Application()
+    app.router.add_post('/shops/invalidate', handle_shops_invalidate)
+    if BOT_MODE == 'webhook':
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    bot_http_runner = web.AppRunner(app)
+    await bot_http_runner.setup()
+    await web.TCPSite(bot_http_runner, BOT_HTTP_HOST, int(BOT_HTTP_PORT)).start()
+    logging.info(f"Bot HTTP server started on {BOT_HTTP_HOST}:{BOT_HTTP_PORT}")
+
+
+async def stop_bot_http_server():
+    global bot_http_runner
+    if bot_http_runner is not None:
+        await bot_http_runner.cleanup()
+        bot_http_runner = None
+    # Даем дообработаться уже принятым обновлениям
+    if webhook_tasks:
+        await asyncio.wait(webhook_tasks, timeout=10)
+
+
+class TimerScheduler:
+    """
+    Единый планировщик таймаутов диалогов вместо отдельной задачи на каждый таймер.
+    Сроки хранятся в куче; одна фоновая задача просыпается к ближайшему сроку
+    (с точностью resolution, чтобы близкие сроки срабатывали одной пачкой)
+    и запускает обработчики всех истекших таймеров.
+    Отмененные и продленные таймеры удаляются из кучи лениво.
+    """
+
+    def __init__(self, resolution: float = 1.0):
+        self.resolution = resolution
+        self.timers = {}
+        self.heap = []
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.batches = set()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def arm(self, chat_id: int, kind: str, delay: float, callback):
+        """Запуск (или перезапуск) таймера kind для чата; callback - корутина без аргументов"""
+        self._push((chat_id, kind), asyncio.get_running_loop().time() + delay, callback)
+
+    def disarm(self, chat_id: int, kind: Optional[str] = None):
+        """Отмена таймера kind или всех таймеров чата"""
+        if kind is not None:
+            self.timers.pop((chat_id, kind), None)
+            return
+        for key in [key for key in self.timers if key[0] == chat_id]:
+            del self.timers[key]
+
+    def extend(self, chat_id: int, kind: str, delay: float):
+        """Продление уже запущенного таймера на delay секунд"""
+        entry = self.timers.get((chat_id, kind))
+        if entry is not None:
+            deadline, _, callback = entry
+            self._push((chat_id, kind), deadline + delay, callback)
+
+    def is_armed(self, chat_id: int, kind: str) -> bool:
+        return (chat_id, kind) in self.timers
+
+    def _push(self, key, deadline: float, callback):
+        self.seq += 1
+        self.timers[key] = (deadline, self.seq, callback)
+        heapq.heappush(self.heap, (deadline, self.seq, key))
+        if self.heap[0][1] == self.seq:
+            # Новый срок раньше всех остальных - будим планировщик
+            self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                deadline, seq, key = heapq.heappop(self.heap)
+                entry = self.timers.get(key)
+                if entry is not None and entry[1] == seq:
+                    del self.timers[key]
+                    due.append((key, entry[2]))
+
+            if due:
+                batch = asyncio.create_task(self._fire(due))
+                self.batches.add(batch)
+                batch.add_done_callback(self.batches.discard)
+
+            self.wakeup.clear()
+            timeout = None
+            if self.heap:
+                timeout = max(self.heap[0][0] - now, 0.0) + self.resolution
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, due: list):
+        results = await asyncio.gather(*(callback() for _, callback in due), return_exceptions=True)
+        for (key, _), result in zip(due, results):
+            if isinstance(result, Exception):
+                logging.error(f"Ошибка обработчика таймера {key}: {result!r}")
+
+
+timer_scheduler = TimerScheduler()
+
+
 bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
-timers = {}
-confirmation_timers = {}
+dp = Dispatcher(storage=create_storage(
+    FSM_STORAGE,
+    sqlite_path=FSM_SQLITE_PATH,
+    db_host=os.getenv("DB_HOST"),
+    db_user=os.getenv("DB_USER"),
+    db_password=os.getenv("DB_PASSWORD"),
+    db_name=os.getenv("DB_NAME")
+))
 
 
 # async def websocket_server():
@@ -86,57 +559,266 @@ confirmation_timers = {}
 async def cleanup_order_data(user_data: dict):
     try:
         if 'order_id' in user_data:
-            async with aiohttp.ClientSession() as session:
-                await session.delete(f"{API_URL}/orders/{user_data['order_id']}")
+            async with api_session.delete(f"{API_URL}/orders/{user_data['order_id']}"):
+                pass
     except Exception as e:
         logging.error(f"Ошибка очистки: {str(e)}")
 
 
-async def start_order_timer(chat_id: int, state: FSMContext):
-    try:
-        await asyncio.sleep(600)
-        if chat_id in timers:
-            user_data = await state.get_data()
-            await cleanup_order_data(user_data)
-            await bot.send_message(chat_id, "❌ Время оформления заказа истекло, ваш заказ отменен", reply_markup=types.ReplyKeyboardRemove())
-            await state.clear()
-            del timers[chat_id]
-    except asyncio.CancelledError:
-        logging.info("10-минутный таймер отменен")
+async def order_timeout(chat_id: int, state: FSMContext):
+    # Заказ отменен целиком - таймер подтверждения больше не нужен
+    timer_scheduler.disarm(chat_id)
+    user_data = await state.get_data()
+    await cleanup_order_data(user_data)
+    await bot.send_message(chat_id, "❌ Время оформления заказа истекло, ваш заказ отменен", reply_markup=types.ReplyKeyboardRemove())
+    await state.clear()
 
 
 async def confirmation_timeout(chat_id: int, state: FSMContext):
+    timer_scheduler.disarm(chat_id)
+    user_data = await state.get_data()
+    await cleanup_order_data(user_data)
+    await bot.send_message(chat_id, "❌ Время подтверждения истекло, ваш заказ отменен", reply_markup=types.ReplyKeyboardRemove())
+    await state.clear()
+
+
+def arm_order_timer(chat_id: int, state: FSMContext, delay: float = ORDER_TIMEOUT):
+    timer_scheduler.arm(chat_id, 'order', delay, lambda: order_timeout(chat_id, state))
+
+
+def arm_confirmation_timer(chat_id: int, state: FSMContext, delay: float = CONFIRMATION_TIMEOUT):
+    timer_scheduler.arm(chat_id, 'confirmation', delay, lambda: confirmation_timeout(chat_id, state))
+
+
+async def restore_pending_state():
+    """
+    Восстановление после перезапуска: таймеры по сохраненным в FSM срокам
+    и удаление временных файлов, на которые не ссылается ни один незавершенный заказ.
+    """
+    storage = dp.storage
+    referenced = set()
+    if hasattr(storage, 'iter_records'):
+        now = time.time()
+        async for key, state_name, data in storage.iter_records():
+            if data.get('temp_file'):
+                referenced.add(os.path.abspath(data['temp_file']))
+            if key.bot_id != bot.id or key.destiny != 'default':
+                continue
+
+            state = FSMContext(storage=storage, key=key)
+            if 'order_deadline' in data:
+                arm_order_timer(key.chat_id, state, max(0.0, data['order_deadline'] - now))
+            if 'confirmation_deadline' in data and state_name == Form.confirmation.state:
+                arm_confirmation_timer(key.chat_id, state, max(0.0, data['confirmation_deadline'] - now))
+        logging.info(f"Восстановлено таймеров: {len(timer_scheduler.timers)}")
+
+    for name in os.listdir(UPLOAD_FOLDER):
+        path = os.path.abspath(os.path.join(UPLOAD_FOLDER, name))
+        if name.startswith('temp_') and path not in referenced:
+            try:
+                os.remove(path)
+                logging.info(f"Удален осиротевший временный файл: {path}")
+            except Exception as e:
+                logging.error(f"Ошибка удаления файла: {str(e)}")
+
+
+# Сигнатуры поддерживаемых форматов: расширение -> начало файла
+FILE_SIGNATURES = (
+    ('.pdf', b'%PDF'),
+    ('.png', b'\x89PNG\r\n\x1a\n'),
+    ('.jpg', b'\xff\xd8\xff'),
+    ('.docx', b'PK\x03\x04'),
+    ('.doc', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'),
+)
+
+
+def sniff_file_format(head: bytes) -> str:
+    """Определение формата по первым байтам файла, '' если формат не распознан"""
+    for ext, signature in FILE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    # Перед заголовком PDF допускается мусор в первом килобайте
+    if b'%PDF' in head[:1024]:
+        return '.pdf'
+    return ''
+
+
+async def download_to_file(resp: aiohttp.ClientResponse, dest_path: str) -> tuple:
+    """
+    Потоковая запись ответа на диск кусками с подсчетом SHA-256 и определением формата
+    в том же проходе. Возвращает (размер, sha256, формат).
+    """
+    sha256 = hashlib.sha256()
+    head = b''
+    size = 0
+    async with aiofiles.open(dest_path, 'wb') as f:
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_FILE_SIZE:
+                raise ValueError("Файл больше 20 МБ")
+            if len(head) < 1024:
+                head += chunk[:1024 - len(head)]
+            sha256.update(chunk)
+            await f.write(chunk)
+    return size, sha256.hexdigest(), sniff_file_format(head)
+
+
+async def fetch_telegram_file(file_id: str, file_ext: str) -> tuple:
+    """Скачивание файла из Telegram во временный файл. Возвращает (путь, размер, sha256, формат)"""
+    file_info = await bot.get_file(file_id)
+    if not file_info.file_path:
+        raise ValueError("Telegram не вернул путь к файлу")
+
+    file_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_info.file_path}"
+    logging.info(f"Начинаем загрузку файла: {file_info.file_path}")
+
+    temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4()}{file_ext}")
     try:
-        await asyncio.sleep(60)
-        if chat_id in confirmation_timers:
-            user_data = await state.get_data()
-            await cleanup_order_data(user_data)
-            await bot.send_message(chat_id, "❌ Время подтверждения истекло, ваш заказ отменен", reply_markup=types.ReplyKeyboardRemove())
-            await state.clear()
-            del confirmation_timers[chat_id]
-    except asyncio.CancelledError:
-        logging.info("1-минутный таймер отменен")
+        # Общий таймаут сессии не подходит для файлов до 20 МБ - ограничиваем только паузы чтения
+        async with telegram_session.get(
+            file_url,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+        ) as resp:
+            if resp.status != 200:
+                raise ValueError(f"Ошибка HTTP {resp.status}: {await resp.text()}")
+
+            file_size, file_hash, detected_ext = await download_to_file(resp, temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return temp_path, file_size, file_hash, detected_ext
 
 
 async def get_page_count(file_path: str, ext: str) -> int:
     try:
-        if ext in ('.png', '.jpg', '.jpeg'):
-            return 1
-        if ext == '.pdf':
-            async with aiofiles.open(file_path, 'rb') as f:
-                content = await f.read()
-                pdf = PdfReader(BytesIO(content))  # Используем BytesIO
-                return len(pdf.pages)
-
-        # return await asyncio.to_thread(_process_word_file, file_path)
-        return await get_docx_page_count_metadata(file_path)
-        # return await get_word_page_count_via_libreoffice(file_path)
-
+        return await page_count_pool.run(count_pages, file_path, ext)
+    except PoolBusyError:
+        raise
     except Exception as e:
         logging.error(f"Ошибка подсчета страниц: {traceback.format_exc()}")
         raise
 
 
+async def get_color_pages(pdf_path: str, pages: int) -> Optional[list]:
+    """
+    Номера цветных страниц PDF или None, если цветность не определена (документ слишком
+    длинный, пул занят, не уложились в COLOR_DETECT_TIMEOUT). Тогда заказ оформляется
+    без варианта "Цветная только где нужно".
+    """
+    if pages > COLOR_DETECT_MAX_PAGES:
+        return None
+    try:
+        return await color_detect_pool.run(detect_color_pages, pdf_path)
+    except PoolBusyError:
+        logging.warning("Пул поиска цветных страниц занят")
+    except asyncio.TimeoutError:
+        logging.warning(f"Поиск цветных страниц не уложился в {COLOR_DETECT_TIMEOUT} с ({pages} стр.)")
+    except Exception as e:
+        logging.error(f"Ошибка поиска цветных страниц: {str(e)}")
+    return None
+
+
+async def analyze_pdf_file(pdf_path: str) -> dict:
+    """Страницы PDF, затем (отдельной задачей) цветные страницы"""
+    pages = await get_page_count(pdf_path, '.pdf')
+    return {'pages': pages, 'color_pages': await get_color_pages(pdf_path, pages)}
+
+
+def format_page_ranges(pages: list) -> str:
+    """[1, 2, 3, 7] -> "1-3,7" (формат диалога печати)"""
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ','.join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def calculate_price(shop: dict, color: str, pages: int, color_pages: Optional[list]) -> float:
+    if color == 'черно-белая':
+        return round(shop['price_bw'] * pages, 2)
+    if color == 'смешанная' and color_pages is not None:
+        return round(shop['price_cl'] * len(color_pages) + shop['price_bw'] * (pages - len(color_pages)), 2)
+    return round(shop['price_cl'] * pages, 2)
+
+
+def has_mixed_colors(user_data: dict) -> bool:
+    color_pages = user_data.get('color_pages')
+    return color_pages is not None and 0 < len(color_pages) < user_data['pages']
+
+
+def color_keyboard(user_data: dict) -> ReplyKeyboardMarkup:
+    keyboard = [
+        [KeyboardButton(text="Черно-белая")],
+        [KeyboardButton(text="Цветная")]
+    ]
+    if has_mixed_colors(user_data):
+        keyboard.append([KeyboardButton(text="Цветная только где нужно")])
+    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+
+async def get_word_page_count(file_path: str, ext: str, analysis: dict) -> int:
+    """
+    Страницы DOC/DOCX: метаданные DOCX дают быструю оценку сразу, а точное число
+    считается конвертацией в PDF в фоне и записывается в analysis (запись кеша анализа).
+    Если оценки нет (DOC или DOCX без метаданных), ждем точный результат.
+    """
+    guess = await get_page_count(file_path, ext) if ext == '.docx' else 0
+    if not doc_converter.available:
+        return guess
+
+    file_hash = analysis['sha256']
+    job = asyncio.create_task(doc_converter.analyze(file_path, analyze_pdf_file))
+    exact_page_jobs[file_hash] = job
+
+    def store_result(task: asyncio.Task):
+        exact_page_jobs.pop(file_hash, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.error(f"Ошибка точного подсчета страниц: {task.exception()!r}")
+            return
+        result = task.result()
+        if result['pages'] > 0:
+            analysis.update(result, pages_exact=True)
+            logging.info(f"Точное количество страниц {file_hash}: {result['pages']} (оценка: {guess})")
+
+    job.add_done_callback(store_result)
+
+    if guess > 0:
+        return guess
+    try:
+        return (await asyncio.shield(job))['pages']
+    except ConverterBusyError:
+        raise PoolBusyError()
+
+
+async def refine_page_count(state: FSMContext):
+    """Перед подтверждением заменяет оценку страниц точным значением и пересчитывает стоимость"""
+    user_data = await state.get_data()
+    file_hash = user_data.get('file_hash')
+    job = exact_page_jobs.get(file_hash)
+    if job is not None:
+        try:
+            await asyncio.wait_for(asyncio.shield(job), timeout=DOC_CONVERTER_TIMEOUT)
+        except Exception:
+            # Ошибка уже записана в лог, остается оценка по метаданным
+            pass
+
+    analysis = analysis_cache.get(file_hash) if file_hash else None
+    if not analysis or not analysis.get('pages_exact') or analysis['pages'] == user_data['pages']:
+        return
+
+    color_pages = analysis.get('color_pages')
+    if color_pages is None:
+        color_pages = user_data.get('color_pages')
+    price = calculate_price(user_data['shop'], user_data['color'], analysis['pages'], color_pages)
+    await state.update_data(pages=analysis['pages'], color_pages=color_pages, price=price)
+
+
 # async def get_page_count(file_path: str, ext: str) -> int:
 #     """
 #     Универсальная функция подсчета страниц с приоритетами:
@@ -169,34 +851,6 @@ async def get_page_count(file_path: str, ext: str) -> int:
 #         # return await get_fallback_page_count(file_path, ext)
 
 
-def _process_word_file(file_path: str) -> int:
-    pythoncom.CoInitialize()
-    try:
-        word = win32com.client.Dispatch("Word.Application")
-        word.Visible = False
-        doc = word.Documents.Open(os.path.abspath(file_path))
-        count = doc.ComputeStatistics(2)
-        doc.Close(False)
-        return count
-    except Exception as e:
-        logging.error(f"Word COM Error: {str(e)}")
-        raise
-    finally:
-        word.Quit()
-        pythoncom.CoUninitialize()
-
-
-async def get_pdf_page_count(file_path: str) -> int:
-    """Подсчет страниц в PDF файле"""
-    try:
-        async with aiofiles.open(file_path, 'rb') as f:
-            content = await f.read()
-            pdf = PdfReader(BytesIO(content))
-            return len(pdf.pages)
-    except Exception as e:
-        logging.error(f"PDF page count error: {str(e)}")
-
-
 # async def get_word_page_count_via_libreoffice(file_path: str) -> int:
 #     """
 #     Точный подсчет страниц Word документов через LibreOffice
@@ -279,21 +933,6 @@ async def get_pdf_page_count(file_path: str) -> int:
 #          logging.error(f"Fallback methods page count error: {str(e)}")
 
 
-async def get_docx_page_count_metadata(file_path: str) -> int:
-    """
-    Подсчет страниц через метаданные DOCX (менее точный, но быстрый)
-    """
-    try:
-        with zipfile.ZipFile(file_path, 'r') as document:
-            dxml = document.read('docProps/app.xml')
-            uglyXml = xml.dom.minidom.parseString(dxml)
-            page_element = uglyXml.getElementsByTagName('Pages')[0]
-            page_count = int(page_element.childNodes[0].nodeValue)
-            return page_count
-    except Exception as e:
-        logging.error(f"DOCX metadata page count error: {str(e)}")
-
-
 # async def get_doc_page_count_fallback(file_path: str) -> int:
 #      """
 #      Fallback для .doc файлов через antiword
@@ -339,13 +978,7 @@ async def cmd_start(message: types.Message):
 
 @dp.message(Command("new_order"))
 async def cmd_new_order(message: types.Message, state: FSMContext):
-    if message.chat.id in timers:
-        timers[message.chat.id].cancel()
-        del timers[message.chat.id]
-
-    if message.chat.id in confirmation_timers:
-        confirmation_timers[message.chat.id].cancel()
-        del confirmation_timers[message.chat.id]
+    timer_scheduler.disarm(message.chat.id)
 
     user_data = await state.get_data()
     temp_file = user_data.get('temp_file')
@@ -366,12 +999,11 @@ async def cmd_new_order(message: types.Message, state: FSMContext):
 
     await state.clear()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{API_URL}/shops") as resp:
-            if resp.status != 200:
-                await message.answer("❌ Ошибка загрузки магазинов")
-                return
-            shops = await resp.json()
+    try:
+        shops = await shop_cache.get_all()
+    except Exception:
+        await message.answer("❌ Ошибка загрузки магазинов")
+        return
 
     markup = ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text=shop['name'])] for shop in shops],
@@ -379,18 +1011,21 @@ async def cmd_new_order(message: types.Message, state: FSMContext):
         one_time_keyboard=True
     )
     await message.answer("🏪 Выберите точку печати из списка:", reply_markup=markup)
-    timers[message.chat.id] = asyncio.create_task(start_order_timer(message.chat.id, state))
+    arm_order_timer(message.chat.id, state)
     await state.set_state(Form.shop_selection)
+    # Срок хранится вместе с состоянием, чтобы восстановить таймер после перезапуска
+    await state.update_data(order_deadline=time.time() + ORDER_TIMEOUT)
 
 
 @dp.message(Form.shop_selection)
 async def process_shop(message: types.Message, state: FSMContext):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{API_URL}/shops/{message.text}") as resp:
-            if resp.status != 200:
-                await message.answer("❌ Точка не найдена. /new_order")
-                return
-            shop = await resp.json()
+    try:
+        shop = await shop_cache.get_by_name(message.text)
+    except Exception:
+        shop = None
+    if shop is None:
+        await message.answer("❌ Точка не найдена. /new_order")
+        return
 
     await state.update_data(shop=shop)
     response = (
@@ -414,86 +1049,102 @@ async def process_file(message: types.Message, state: FSMContext):
     temp_path = None
 
     try:
-        # 1. Получаем информацию о файле
-        file_info = await bot.get_file(message.document.file_id)
-        if not file_info.file_path:
-            raise ValueError("Telegram не вернул путь к файлу")
-
-        # 2. Формируем URL для скачивания
-        file_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_info.file_path}"
-        logging.info(f"Начинаем загрузку файла: {file_url}")
-
-        # 3. Скачиваем файл
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(file_url) as resp:
-                if resp.status != 200:
-                    raise ValueError(f"Ошибка HTTP {resp.status}: {await resp.text()}")
-
-                file_content = await resp.read()
-                if not file_content:
-                    raise ValueError("Получен пустой файл")
-
-        # 4. Проверяем расширение файла
+        # 1. Проверяем расширение и размер файла до скачивания
         filename = message.document.file_name or "unnamed_file"
         file_ext = os.path.splitext(filename)[1].lower()
 
         if file_ext not in ('.pdf', '.doc', '.docx', '.png', '.jpg', '.jpeg'):
             raise ValueError("Поддерживаются только следующие форматы: PDF, DOC, DOCX, PNG, JPEG, JPG")
-
-        # 5. Сохраняем временный файл
-        temp_name = f"temp_{uuid.uuid4()}{file_ext}"
-        temp_path = os.path.join(UPLOAD_FOLDER, temp_name)
-
-        async with aiofiles.open(temp_path, 'wb') as f:
-            await f.write(file_content)
-
-        # 6. Проверяем что файл сохранился
-        if not os.path.exists(temp_path):
-            raise ValueError("Не удалось сохранить файл на диск")
-
-        # 7. Подсчитываем количество страниц
-        pages = await get_page_count(temp_path, file_ext)
-        logging.info(f"Определено страниц: {pages}")
-
-        if pages < 1:
-            raise ValueError("⚠️ Не удалось определить количество страниц")
-
-        # 8. Сохраняем данные в состояние
+        if message.document.file_size and message.document.file_size > MAX_FILE_SIZE:
+            raise ValueError("Файл больше 20 МБ")
+
+        # 2. Этот файл уже присылали - скачаем его только при подтверждении заказа
+        file_unique_id = message.document.file_unique_id
+        analysis = analysis_cache.get(file_unique_id)
+        if analysis is not None:
+            logging.info(f"Результат анализа файла взят из кеша: {file_unique_id}")
+        else:
+            # 3. Скачиваем файл сразу на диск, считая хеш и определяя формат
+            temp_path, file_size, file_hash, detected_ext = await fetch_telegram_file(message.document.file_id, file_ext)
+
+            if not file_size:
+                raise ValueError("Получен пустой файл")
+            if not detected_ext:
+                raise ValueError("Не удалось распознать формат файла")
+
+            # 4. Тот же файл мог прийти от другого пользователя - ищем по содержимому
+            analysis = analysis_cache.get(file_hash)
+            if analysis is None:
+                # 5. Подсчитываем количество страниц
+                analysis = {'pages': 0, 'ext': detected_ext, 'sha256': file_hash, 'pages_exact': True, 'color_pages': None}
+                try:
+                    if detected_ext in ('.doc', '.docx'):
+                        analysis['pages_exact'] = False
+                        pages = await get_word_page_count(temp_path, detected_ext, analysis)
+                    elif detected_ext == '.pdf':
+                        analysis.update(await analyze_pdf_file(temp_path))
+                        pages = analysis['pages']
+                    else:
+                        pages = await get_page_count(temp_path, detected_ext)
+                except asyncio.TimeoutError:
+                    raise ValueError("Файл обрабатывается слишком долго, попробуйте другой файл")
+                logging.info(f"Определено страниц: {pages}")
+
+                if pages < 1:
+                    raise ValueError("⚠️ Не удалось определить количество страниц")
+                if not analysis['pages']:
+                    analysis['pages'] = pages
+            analysis_cache.put((file_unique_id, file_hash), analysis)
+
+        # 6. Сверяем формат с содержимым: переименованный DOCX в .doc считаем DOCX
+        detected_ext = analysis['ext']
+        if detected_ext != file_ext and {detected_ext, file_ext} != {'.jpg', '.jpeg'}:
+            logging.info(f"Расширение {file_ext} не совпадает с содержимым {detected_ext}: {filename}")
+            file_ext = detected_ext
+            filename = os.path.splitext(filename)[0] + detected_ext
+        pages = analysis['pages']
+
+        # 7. Сохраняем данные в состояние
         await state.update_data({
             'temp_file': temp_path,
+            'file_id': message.document.file_id,
             'pages': pages,
             'file_extension': file_ext[1:],
             'filename': filename,
-            'original_file_url': file_url
+            'file_hash': analysis['sha256'],
+            'color_pages': analysis.get('color_pages')
         })
 
-        # 9. Запрашиваем тип печати
-        markup = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Черно-белая")],
-                [KeyboardButton(text="Цветная")]
-            ],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        # 8. Запрашиваем тип печати
+        user_data = await state.get_data()
+        color_line = ""
+        if has_mixed_colors(user_data):
+            shop = user_data['shop']
+            color_line = (
+                f"Цветных страниц: {len(user_data['color_pages'])} ({format_page_ranges(user_data['color_pages'])})\n"
+                f"Цветная только где нужно: "
+                f"{calculate_price(shop, 'смешанная', pages, user_data['color_pages']):.2f} руб\n"
+            )
+        elif user_data.get('color_pages') == []:
+            color_line = "Цветных страниц нет\n"
 
         await message.answer(
             f"📄 Файл успешно обработан!\n"
             f"Количество страниц: {pages}\n"
+            f"{color_line}"
             f"Выберите тип печати:",
-            reply_markup=markup
+            reply_markup=color_keyboard(user_data)
         )
 
         await state.set_state(Form.color_selection)
 
+    except PoolBusyError:
+        # Заказ не отменяем - пользователь может просто отправить файл еще раз
+        await message.answer("⏳ Сейчас обрабатывается слишком много файлов. Отправьте файл еще раз через минуту")
+        logging.warning("Page count pool is busy")
+
     except ValueError as ve:
-        if message.chat.id in timers:
-            timers[message.chat.id].cancel()
-            del timers[message.chat.id]
-        if message.chat.id in confirmation_timers:
-            confirmation_timers[message.chat.id].cancel()
-            del confirmation_timers[message.chat.id]
+        timer_scheduler.disarm(message.chat.id)
         await state.clear()
 
         error_msg = f"❌ Ошибка: {str(ve)}. Используйте /new_order для начала нового заказа"
@@ -501,12 +1152,7 @@ async def process_file(message: types.Message, state: FSMContext):
         logging.warning(error_msg)
 
     except Exception as e:
-        if message.chat.id in timers:
-            timers[message.chat.id].cancel()
-            del timers[message.chat.id]
-        if message.chat.id in confirmation_timers:
-            confirmation_timers[message.chat.id].cancel()
-            del confirmation_timers[message.chat.id]
+        timer_scheduler.disarm(message.chat.id)
         await state.clear()
 
         error_msg = f"❌ Критическая ошибка обработки файла: {str(e)}"
@@ -530,17 +1176,14 @@ async def process_file(message: types.Message, state: FSMContext):
 @dp.message(Form.color_selection)
 async def process_color(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
-    color = message.text.lower()
-    if color not in ['черно-белая', 'цветная']:
-        markup = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="Черно-белая"), KeyboardButton(text="Цветная")]],
-            resize_keyboard=True
-        )
-        await message.answer("❌ Неверный тип печати! Выберите вариант из кнопок ниже:", reply_markup=markup)
+    color = (message.text or '').lower()
+    if color == 'цветная только где нужно' and has_mixed_colors(user_data):
+        color = 'смешанная'
+    if color not in ['черно-белая', 'цветная', 'смешанная']:
+        await message.answer("❌ Неверный тип печати! Выберите вариант из кнопок ниже:", reply_markup=color_keyboard(user_data))
         return
 
-    price = user_data['shop']['price_bw'] if color == 'черно-белая' else user_data['shop']['price_cl']
-    total_price = round(price * user_data['pages'], 2)
+    total_price = calculate_price(user_data['shop'], color, user_data['pages'], user_data.get('color_pages'))
     await state.update_data(color=color, price=total_price)
 
     # Добавляем клавиатуру с кнопкой "Без комментария"
@@ -583,11 +1226,16 @@ async def process_comment(message: types.Message, state: FSMContext):
         return  # Остаемся в состоянии Form.comment
 
     await state.update_data(comment=comment)
+    await refine_page_count(state)
     user_data = await state.get_data()
 
     # Определяем расширение файла
     file_ext = user_data.get('file_extension', '').lower()
 
+    color_text = user_data['color']
+    if color_text == 'смешанная':
+        color_text = f"цветная только на страницах {format_page_ranges(user_data['color_pages'])}"
+
     # Формируем строку стоимости
     cost_line = (
         "• Стоимость: уточняйте на точке"
@@ -599,7 +1247,7 @@ async def process_comment(message: types.Message, state: FSMContext):
         f"🔍 Подтвердите заказ:\n"
         f"• Точка: {user_data['shop']['name']} по адресу {user_data['shop']['address']}\n"
         f"• Страниц: {user_data['pages']}\n"
-        f"• Тип: {user_data['color']}\n"
+        f"• Тип: {color_text}\n"
         f"{cost_line}\n"  
         f"• Комментарий: {comment if comment else 'нет'}\n"
         f"Внимание! Это предварительная цена, не являющаяся публичной офертой. Итоговую стоимость уточняйте на точке печати"
@@ -612,10 +1260,11 @@ async def process_comment(message: types.Message, state: FSMContext):
 
     confirmation_msg = await message.answer(response, reply_markup=markup)
 
-    confirmation_timers[message.chat.id] = asyncio.create_task(
-        confirmation_timeout(message.chat.id, state)
+    arm_confirmation_timer(message.chat.id, state)
+    await state.update_data(
+        confirmation_msg_id=confirmation_msg.message_id,
+        confirmation_deadline=time.time() + CONFIRMATION_TIMEOUT
     )
-    await state.update_data(confirmation_msg_id=confirmation_msg.message_id)
     await state.set_state(Form.confirmation)
 
 
@@ -629,12 +1278,7 @@ async def process_confirmation(message: types.Message, state: FSMContext):
         await message.answer("⚠️ Пожалуйста, используйте кнопки для подтверждения:", reply_markup=markup)
         return
 
-    if message.chat.id in timers:
-        timers[message.chat.id].cancel()
-        del timers[message.chat.id]
-    if message.chat.id in confirmation_timers:
-        confirmation_timers[message.chat.id].cancel()
-        del confirmation_timers[message.chat.id]
+    timer_scheduler.disarm(message.chat.id)
 
     user_data = await state.get_data()
     temp_file_path = user_data.get('temp_file')
@@ -653,35 +1297,50 @@ async def process_confirmation(message: types.Message, state: FSMContext):
     check_code = random.randint(1000, 9999)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            form_data = aiohttp.FormData()
-            form_data.add_field('ID_shop', str(user_data['shop']['ID_shop']))
-            form_data.add_field('price', str(user_data['price']))
-            form_data.add_field('pages', str(user_data['pages']))
-            form_data.add_field('color', user_data['color'])
-            form_data.add_field('user_id', str(message.chat.id))
-            form_data.add_field('note', user_data.get('comment', ''))
-            form_data.add_field('file_extension', user_data['file_extension'])
-            form_data.add_field('con_code', str(check_code))
-
-            with open(temp_file_path, 'rb') as file:
-                form_data.add_field('file', file.read(), filename=user_data['filename'])
-
-            async with session.post(f"{API_URL}/orders", data=form_data) as resp:
-                if resp.status == 201:
-                    data = await resp.json()
-                    await message.answer(
-                        f"✅ Заказ №{data['order_id']} принят! Проверочный код: {check_code}",
-                        reply_markup=types.ReplyKeyboardRemove()
-                    )
-                    if temp_file_path and os.path.exists(temp_file_path):
-                        try:
-                            os.remove(temp_file_path)
-                            logging.info(f"Удалён временный файл: {temp_file_path}")
-                        except Exception as e:
-                            logging.error(f"Ошибка удаления временного файла: {str(e)}")
-                else:
-                    await message.answer("❌ Ошибка подтверждения заказа")
+        form_data = aiohttp.FormData()
+        form_data.add_field('ID_shop', str(user_data['shop']['ID_shop']))
+        form_data.add_field('price', str(user_data['price']))
+        form_data.add_field('pages', str(user_data['pages']))
+        form_data.add_field('color', user_data['color'])
+        form_data.add_field('user_id', str(message.chat.id))
+        form_data.add_field('note', user_data.get('comment', ''))
+        form_data.add_field('file_extension', user_data['file_extension'])
+        form_data.add_field('con_code', str(check_code))
+        if user_data.get('color_pages') is not None:
+            form_data.add_field('color_pages', str(len(user_data['color_pages'])))
+            form_data.add_field('color_page_list', format_page_ranges(user_data['color_pages']))
+
+        # Файл из кеша анализа еще не скачан - скачиваем только сейчас
+        if not temp_file_path or not os.path.exists(temp_file_path):
+            temp_file_path, _, _, _ = await fetch_telegram_file(
+                user_data['file_id'], '.' + user_data['file_extension']
+            )
+
+        # Файл передается потоком прямо с диска, без чтения в память
+        with open(temp_file_path, 'rb') as file:
+            form_data.add_field('file', file, filename=user_data['filename'])
+
+            async with api_session.post(
+                f"{API_URL}/orders",
+                data=form_data,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+            ) as resp:
+                data = await resp.json() if resp.status == 201 else None
+
+        # Файл удаляется только после закрытия (на Windows открытый файл не удалить)
+        if data is not None:
+            await message.answer(
+                f"✅ Заказ №{data['order_id']} принят! Проверочный код: {check_code}",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            if temp_file_path and os.path.exists(temp_file_path):
+                try:
+                    os.remove(temp_file_path)
+                    logging.info(f"Удалён временный файл: {temp_file_path}")
+                except Exception as e:
+                    logging.error(f"Ошибка удаления временного файла: {str(e)}")
+        else:
+            await message.answer("❌ Ошибка подтверждения заказа")
     except Exception as e:
         await message.answer("❌ Ошибка создания заказа")
         logging.error(f"Ошибка подтверждения: {traceback.format_exc()}")
@@ -692,13 +1351,7 @@ async def process_confirmation(message: types.Message, state: FSMContext):
 @dp.message(Command("reset"))
 async def cmd_reset(message: types.Message, state: FSMContext):
     try:
-        if message.chat.id in timers:
-            timers[message.chat.id].cancel()
-            del timers[message.chat.id]
-
-        if message.chat.id in confirmation_timers:
-            confirmation_timers[message.chat.id].cancel()
-            del confirmation_timers[message.chat.id]
+        timer_scheduler.disarm(message.chat.id)
 
         user_data = await state.get_data()
         temp_file = user_data.get('temp_file')
@@ -734,7 +1387,61 @@ async def handle_unknown(message: types.Message):
     await message.reply("Не понимаю тебя, попробуй повторить запрос ☺️")
 
 
+async def on_startup():
+    page_count_pool.start()
+    color_detect_pool.start()
+    doc_converter.start()
+    timer_scheduler.start()
+    analysis_cache.load()
+    await init_http_sessions()
+    await start_bot_http_server()
+    await restore_pending_state()
+
+
+async def on_shutdown():
+    await timer_scheduler.stop()
+    await stop_bot_http_server()
+    await close_http_sessions()
+    await doc_converter.stop()
+    page_count_pool.shutdown()
+    color_detect_pool.shutdown()
+    analysis_cache.save()
+
+
+async def run_webhook() -> bool:
+    """Работа в режиме webhook. Возвращает False, если webhook не удалось включить"""
+    await dp.emit_startup(bot=bot)
+    try:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logging.info(f"Webhook mode: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    except Exception as e:
+        logging.error(f"Не удалось установить webhook, переходим на polling: {str(e)}")
+        await dp.emit_shutdown(bot=bot)
+        return False
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+    return True
+
+
 async def main():
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    if BOT_MODE == 'webhook' and WEBHOOK_URL and BOT_HTTP_PORT:
+        if await run_webhook():
+            return
+    elif BOT_MODE == 'webhook':
+        logging.error("Для webhook нужны WEBHOOK_URL и BOT_HTTP_PORT, переходим на polling")
+
+    # Polling не работает, пока у бота установлен webhook
+    await bot.delete_webhook()
     await asyncio.gather(dp.start_polling(bot), )  # + websocket_server()
 
 
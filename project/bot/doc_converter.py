@@ -0,0 +1,107 @@
+import os
+import shutil
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+
+# Точный подсчет страниц DOC/DOCX через конвертацию в PDF headless LibreOffice (работает и на Linux).
+# Каждый слот пула использует свой заранее инициализированный профиль LibreOffice:
+# первый запуск с пустым профилем - самая долгая часть, а отдельные профили позволяют
+# нескольким конвертациям идти параллельно, не блокируя друг друга.
+
+
+class ConverterBusyError(Exception):
+    """Очередь конвертации переполнена"""
+
+
+class DocConverterPool:
+    def __init__(self, binary: str, workers: int, max_queue: int, timeout: float, profile_root: str):
+        self.binary = shutil.which(binary)
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.timeout = timeout
+        self.profile_root = profile_root
+        self.pending = 0
+        self.slots = None
+        self.warmup_task = None
+
+    @property
+    def available(self) -> bool:
+        return self.binary is not None and self.slots is not None
+
+    def profile_dir(self, slot: int) -> str:
+        return os.path.join(self.profile_root, f"worker_{slot}")
+
+    def start(self):
+        if self.binary is None:
+            logging.warning("LibreOffice не найден, страницы DOC/DOCX считаются только по метаданным")
+            return
+        self.slots = asyncio.Queue()
+        for slot in range(self.workers):
+            os.makedirs(self.profile_dir(slot), exist_ok=True)
+            self.slots.put_nowait(slot)
+        # Прогрев профилей не задерживает запуск бота
+        self.warmup_task = asyncio.create_task(self._warmup())
+
+    async def stop(self):
+        if self.warmup_task is not None:
+            self.warmup_task.cancel()
+            self.warmup_task = None
+
+    async def _warmup(self):
+        async def warm(slot: int):
+            try:
+                await self._run(slot, '--terminate_after_init')
+            except Exception as e:
+                logging.warning(f"Прогрев профиля LibreOffice {slot} не удался: {str(e)}")
+        await asyncio.gather(*(warm(slot) for slot in range(self.workers)))
+        logging.info(f"Профили LibreOffice готовы: {self.workers}")
+
+    async def _run(self, slot: int, *args) -> int:
+        process = await asyncio.create_subprocess_exec(
+            self.binary,
+            f"-env:UserInstallation={Path(self.profile_dir(slot)).as_uri()}",
+            '--headless', '--norestore', '--nologo',
+            *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            logging.error(f"LibreOffice завершился с кодом {process.returncode}: {stderr.decode(errors='ignore')}")
+        return process.returncode
+
+    async def convert_to_pdf(self, file_path: str, out_dir: str) -> str:
+        """Конвертация документа в PDF в out_dir. Возвращает путь к PDF"""
+        if self.pending >= self.capacity:
+            raise ConverterBusyError()
+
+        self.pending += 1
+        try:
+            slot = await self.slots.get()
+            try:
+                await self._run(slot, '--convert-to', 'pdf', '--outdir', out_dir, file_path)
+            finally:
+                self.slots.put_nowait(slot)
+        finally:
+            self.pending -= 1
+
+        pdf_path = os.path.join(out_dir, Path(file_path).stem + '.pdf')
+        if not os.path.exists(pdf_path):
+            raise RuntimeError("LibreOffice не создал PDF файл")
+        return pdf_path
+
+    async def analyze(self, file_path: str, analyze_pdf):
+        """Конвертирует документ и возвращает результат корутины analyze_pdf(путь к PDF)"""
+        out_dir = tempfile.mkdtemp(prefix='doc_convert_')
+        try:
+            pdf_path = await self.convert_to_pdf(file_path, out_dir)
+            return await analyze_pdf(pdf_path)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
@@ -0,0 +1,220 @@
+import json
+import asyncio
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+import aiomysql
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.memory import MemoryStorage
+
+# Постоянные хранилища состояний FSM бота.
+# Каждое состояние - одна компактная запись: ключ, название состояния и данные в JSON.
+# Пустые записи (нет состояния и данных) удаляются.
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+def _key_params(key: StorageKey) -> tuple:
+    return key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny
+
+
+def _dump_data(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище в локальном файле SQLite (режим WAL позволяет работать нескольким процессам)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # Соединение открывается заново и после close(): при переходе с webhook на polling
+        # диспетчер закрывает хранилище и запускается снова
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS bot_fsm (
+                bot_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                thread_id INTEGER NOT NULL,
+                destiny TEXT NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+            )
+        """)
+
+    async def _execute(self, query: str, params: tuple = (), fetch: bool = False):
+        def run():
+            with self.lock:
+                if self.conn is None:
+                    self._connect()
+                cursor = self.conn.execute(query, params)
+                return cursor.fetchall() if fetch else None
+        return await asyncio.to_thread(run)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._execute(
+            "INSERT INTO bot_fsm (bot_id, chat_id, user_id, thread_id, destiny, state) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (bot_id, chat_id, user_id, thread_id, destiny) DO UPDATE SET state = excluded.state",
+            _key_params(key) + (_state_name(state),)
+        )
+        await self._cleanup(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        rows = await self._execute(
+            "SELECT state FROM bot_fsm WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?",
+            _key_params(key), fetch=True
+        )
+        return rows[0][0] if rows else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._execute(
+            "INSERT INTO bot_fsm (bot_id, chat_id, user_id, thread_id, destiny, data) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (bot_id, chat_id, user_id, thread_id, destiny) DO UPDATE SET data = excluded.data",
+            _key_params(key) + (_dump_data(data),)
+        )
+        await self._cleanup(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        rows = await self._execute(
+            "SELECT data FROM bot_fsm WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?",
+            _key_params(key), fetch=True
+        )
+        return json.loads(rows[0][0]) if rows else {}
+
+    async def _cleanup(self, key: StorageKey):
+        await self._execute(
+            "DELETE FROM bot_fsm WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ? "
+            "AND state IS NULL AND data = '{}'",
+            _key_params(key)
+        )
+
+    async def iter_records(self):
+        """Все сохраненные записи: (ключ, состояние, данные)"""
+        rows = await self._execute(
+            "SELECT bot_id, chat_id, user_id, thread_id, destiny, state, data FROM bot_fsm", fetch=True
+        )
+        for bot_id, chat_id, user_id, thread_id, destiny, state, data in rows:
+            key = StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=user_id,
+                             thread_id=thread_id or None, destiny=destiny)
+            yield key, state, json.loads(data)
+
+    async def close(self) -> None:
+        def run():
+            with self.lock:
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+        await asyncio.to_thread(run)
+
+
+class MySQLStorage(BaseStorage):
+    """Хранилище в той же БД MySQL, что и API, - общее для нескольких процессов бота"""
+
+    def __init__(self, **connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        self.pool = None
+
+    async def _get_pool(self):
+        if self.pool is None:
+            self.pool = await aiomysql.create_pool(autocommit=True, minsize=1, maxsize=5, **self.connect_kwargs)
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        CREATE TABLE IF NOT EXISTS bot_fsm (
+                            bot_id BIGINT NOT NULL,
+                            chat_id BIGINT NOT NULL,
+                            user_id BIGINT NOT NULL,
+                            thread_id BIGINT NOT NULL,
+                            destiny VARCHAR(32) NOT NULL,
+                            state VARCHAR(255) NULL,
+                            data TEXT NOT NULL,
+                            PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+                        )
+                    """)
+        return self.pool
+
+    async def _execute(self, query: str, params: tuple = (), fetch: bool = False):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, params)
+                return await cursor.fetchall() if fetch else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._execute(
+            "INSERT INTO bot_fsm (bot_id, chat_id, user_id, thread_id, destiny, state, data) "
+            "VALUES (%s, %s, %s, %s, %s, %s, '{}') ON DUPLICATE KEY UPDATE state = VALUES(state)",
+            _key_params(key) + (_state_name(state),)
+        )
+        await self._cleanup(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        rows = await self._execute(
+            "SELECT state FROM bot_fsm WHERE bot_id = %s AND chat_id = %s AND user_id = %s "
+            "AND thread_id = %s AND destiny = %s",
+            _key_params(key), fetch=True
+        )
+        return rows[0][0] if rows else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._execute(
+            "INSERT INTO bot_fsm (bot_id, chat_id, user_id, thread_id, destiny, data) "
+            "VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE data = VALUES(data)",
+            _key_params(key) + (_dump_data(data),)
+        )
+        await self._cleanup(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        rows = await self._execute(
+            "SELECT data FROM bot_fsm WHERE bot_id = %s AND chat_id = %s AND user_id = %s "
+            "AND thread_id = %s AND destiny = %s",
+            _key_params(key), fetch=True
+        )
+        return json.loads(rows[0][0]) if rows else {}
+
+    async def _cleanup(self, key: StorageKey):
+        await self._execute(
+            "DELETE FROM bot_fsm WHERE bot_id = %s AND chat_id = %s AND user_id = %s AND thread_id = %s "
+            "AND destiny = %s AND state IS NULL AND data = '{}'",
+            _key_params(key)
+        )
+
+    async def iter_records(self):
+        """Все сохраненные записи: (ключ, состояние, данные)"""
+        rows = await self._execute(
+            "SELECT bot_id, chat_id, user_id, thread_id, destiny, state, data FROM bot_fsm", fetch=True
+        )
+        for bot_id, chat_id, user_id, thread_id, destiny, state, data in rows:
+            key = StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=user_id,
+                             thread_id=thread_id or None, destiny=destiny)
+            yield key, state, json.loads(data)
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+
+def create_storage(kind: str, **options) -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE: memory, sqlite или mysql"""
+    if kind == 'sqlite':
+        return SQLiteStorage(options['sqlite_path'])
+    if kind == 'mysql':
+        return MySQLStorage(
+            host=options['db_host'],
+            user=options['db_user'],
+            password=options['db_password'],
+            db=options['db_name']
+        )
+    return MemoryStorage()
@@ -0,0 +1,76 @@
+import os
+import logging
+import zipfile
+import xml.dom.minidom
+import fitz
+import numpy as np
+from PyPDF2 import PdfReader
+
+# Функции этого модуля выполняются в процессах пула ProcessPoolExecutor бота,
+# поэтому они синхронные и не зависят от состояния бота
+
+COLOR_DPI = 36  # разрешения превью хватает, чтобы заметить цветной текст и иллюстрации
+COLOR_TOLERANCE = 24  # разброс каналов RGB, до которого пиксель считается оттенком серого
+COLOR_BAND_ROWS = 64  # строк пикселей в одной проверке
+
+
+def report_worker_pid(pid_queue):
+    """Инициализатор процесса пула: сообщает боту PID, чтобы зависший процесс можно было завершить"""
+    pid_queue.put(os.getpid())
+
+
+def count_pages(file_path: str, ext: str) -> int:
+    if ext in ('.png', '.jpg', '.jpeg'):
+        return 1
+    if ext == '.pdf':
+        return get_pdf_page_count(file_path)
+    return get_docx_page_count_metadata(file_path)
+
+
+def get_pdf_page_count(file_path: str) -> int:
+    """Подсчет страниц в PDF файле"""
+    with open(file_path, 'rb') as f:
+        pdf = PdfReader(f)
+        return len(pdf.pages)
+
+
+def get_docx_page_count_metadata(file_path: str) -> int:
+    """
+    Подсчет страниц через метаданные DOCX (менее точный, но быстрый)
+    """
+    try:
+        with zipfile.ZipFile(file_path, 'r') as document:
+            dxml = document.read('docProps/app.xml')
+            uglyXml = xml.dom.minidom.parseString(dxml)
+            page_element = uglyXml.getElementsByTagName('Pages')[0]
+            page_count = int(page_element.childNodes[0].nodeValue)
+            return page_count
+    except Exception as e:
+        logging.error(f"DOCX metadata page count error: {str(e)}")
+        return 0
+
+
+def detect_color_pages(file_path: str) -> list:
+    """
+    Номера (с 1) цветных страниц PDF. Страницы растеризуются в низком разрешении,
+    проверка страницы прекращается на первой полосе с цветным пикселем
+    """
+    color_pages = []
+    with fitz.open(file_path) as document:
+        for number, page in enumerate(document, start=1):
+            pixmap = page.get_pixmap(dpi=COLOR_DPI, colorspace=fitz.csRGB, alpha=False)
+            rows = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)
+            pixels = rows[:, :pixmap.width * 3].reshape(pixmap.height, pixmap.width, 3)
+            if has_color_pixels(pixels):
+                color_pages.append(number)
+    return color_pages
+
+
+def has_color_pixels(pixels: np.ndarray) -> bool:
+    """Есть ли в изображении (высота x ширина x RGB) пиксель с заметно различающимися каналами"""
+    for start in range(0, pixels.shape[0], COLOR_BAND_ROWS):
+        band = pixels[start:start + COLOR_BAND_ROWS]
+        if (band.max(axis=2) - band.min(axis=2) > COLOR_TOLERANCE).any():
+            return True
+    return False
+
@@ -8,14 +8,18 @@ import json
 import requests
 import traceback
 import aiofiles
-from PyQt6.QtCore import Qt, QTimer, QThread, pyqtSignal
+from PyQt6.QtCore import (
+    Qt, QTimer, QThread, pyqtSignal, QAbstractListModel, QModelIndex,
+    QSortFilterProxyModel, QRect, QSize, QEvent
+)
 from PyQt6.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QListWidget, QPushButton,
-    QLabel, QMessageBox, QHBoxLayout, QListWidgetItem,
+    QApplication, QWidget, QVBoxLayout, QListView, QPushButton,
+    QLabel, QMessageBox, QHBoxLayout, QComboBox,
     QLineEdit, QDialog, QDialogButtonBox, QFormLayout,
-    QSpacerItem, QSizePolicy, QMenu, QToolButton
+    QSpacerItem, QSizePolicy, QMenu, QToolButton,
+    QStyledItemDelegate, QStyle, QStyleOptionButton
 )
-from PyQt6.QtGui import QIcon
+from PyQt6.QtGui import QIcon, QColor, QFont, QPen
 import qasync
 from qasync import asyncSlot, QEventLoop
 from typing import Optional
@@ -31,6 +35,13 @@ load_dotenv(dotenv_path=env_path)
 API_URL = os.getenv("API_URL")
 DOWNLOAD_DIR = os.path.abspath('downloads')
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+POLL_INTERVAL_MS = 350000  # опрос сервера, только пока нет соединения с потоком событий
+FEED_RECONNECT_MIN_DELAY = 1  # секунды
+FEED_RECONNECT_MAX_DELAY = 60  # секунды
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RETRIES = 5
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_DISK_BUDGET = int(os.getenv("PREFETCH_DISK_BUDGET", str(500 * 1024 * 1024)))  # байты
 
 aiohttp_session: Optional[aiohttp.ClientSession] = None
 
@@ -221,14 +232,260 @@ class LoginDialog(QDialog):
                 found_buttons[0].setEnabled(True)
 
 
+def local_filename(order) -> str:
+    """
+    Имя локальной копии файла заказа. На сервере file_path - имя в хранилище по хешу
+    содержимого (для URL), а оператору нужно видеть, к какому заказу относится файл
+    """
+    return f"order_{order['ID']}{os.path.splitext(order['file_path'])[1]}"
+
+
+def downloads_disk_usage() -> int:
+    total = 0
+    for entry in os.scandir(DOWNLOAD_DIR):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+class FilePrefetcher:
+    """
+    Фоновая загрузка файлов новых заказов в DOWNLOAD_DIR.
+    Заказы ставятся в очередь от старых к новым, семафор ограничивает число
+    одновременных загрузок, новые загрузки не начинаются после превышения бюджета диска.
+    """
+
+    def __init__(self, download, concurrency: int, disk_budget: int):
+        self.download = download
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.disk_budget = disk_budget
+        self.tasks = {}
+
+    def schedule(self, orders):
+        for order in sorted(orders, key=lambda o: o['ID']):
+            order_id = order['ID']
+            if order['status'] != 'received' or order_id in self.tasks:
+                continue
+            if os.path.exists(os.path.join(DOWNLOAD_DIR, local_filename(order))):
+                continue
+            task = asyncio.ensure_future(self._prefetch(order))
+            self.tasks[order_id] = task
+            task.add_done_callback(lambda _, order_id=order_id: self.tasks.pop(order_id, None))
+
+    async def _prefetch(self, order):
+        async with self.semaphore:
+            filename = local_filename(order)
+            if os.path.exists(os.path.join(DOWNLOAD_DIR, filename)):
+                return
+            if downloads_disk_usage() >= self.disk_budget:
+                logging.info(f"Prefetch of order {order['ID']} skipped: disk budget exhausted")
+                return
+            url = f"{API_URL}/files/{order['file_path']}"
+            if await self.download(url, filename, show_errors=False, order_id=order['ID']):
+                logging.info(f"Prefetched file for order {order['ID']}: {filename}")
+
+    def cancel_all(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+
+class OrderListModel(QAbstractListModel):
+    """Модель заказов точки, обновляется по ID заказа без пересоздания строк"""
+    OrderRole = Qt.ItemDataRole.UserRole + 1
+    DownloadingRole = Qt.ItemDataRole.UserRole + 2
+    ProgressRole = Qt.ItemDataRole.UserRole + 3
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._orders = []
+        self._rows = {}
+        self._downloading = set()
+        self._progress = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._orders)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        order = self._orders[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"Заказ №{order['ID']}: {local_filename(order)}"
+        if role == self.OrderRole:
+            return order
+        if role == self.DownloadingRole:
+            return order['ID'] in self._downloading
+        if role == self.ProgressRole:
+            return self._progress.get(order['ID'])
+        return None
+
+    def set_orders(self, orders):
+        incoming = {order['ID']: order for order in orders}
+
+        # Удаляем с конца, чтобы номера оставшихся строк не сдвигались
+        for row in range(len(self._orders) - 1, -1, -1):
+            if self._orders[row]['ID'] not in incoming:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._orders[row]
+                self.endRemoveRows()
+        self._rows = {order['ID']: row for row, order in enumerate(self._orders)}
+
+        for order_id, order in incoming.items():
+            row = self._rows.get(order_id)
+            if row is None:
+                row = len(self._orders)
+                self.beginInsertRows(QModelIndex(), row, row)
+                self._orders.append(order)
+                self._rows[order_id] = row
+                self.endInsertRows()
+            elif self._orders[row] != order:
+                self._orders[row] = order
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+
+    def set_downloading(self, order_id, downloading: bool):
+        if downloading:
+            self._downloading.add(order_id)
+        else:
+            self._downloading.discard(order_id)
+        row = self._rows.get(order_id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [self.DownloadingRole])
+
+    def set_download_progress(self, order_id, percent: Optional[int]):
+        if percent is None:
+            self._progress.pop(order_id, None)
+        else:
+            self._progress[order_id] = percent
+        row = self._rows.get(order_id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [self.ProgressRole])
+
+
+class OrderFilterProxyModel(QSortFilterProxyModel):
+    """Заказы одного статуса с фильтром по типу печати и сортировкой по возрасту (номеру заказа)"""
+
+    def __init__(self, status: str, parent=None):
+        super().__init__(parent)
+        self.status = status
+        self.color_filter = None
+        self.setDynamicSortFilter(True)
+
+    def set_color_filter(self, color: Optional[str]):
+        self.color_filter = color
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        order = self.sourceModel().index(source_row, 0, source_parent).data(OrderListModel.OrderRole)
+        if order['status'] != self.status:
+            return False
+        if self.color_filter and str(order.get('color', '')).lower() != self.color_filter:
+            return False
+        return True
+
+    def lessThan(self, left, right):
+        return left.data(OrderListModel.OrderRole)['ID'] < right.data(OrderListModel.OrderRole)['ID']
+
+
+class OrderItemDelegate(QStyledItemDelegate):
+    """Отрисовка строки заказа: кнопки действий и подпись, без виджетов на каждую строку"""
+    buttonClicked = pyqtSignal(str, dict)
+
+    ROW_HEIGHT = 46
+    MARGIN_X = 10
+    MARGIN_Y = 5
+    SPACING = 10
+    BUTTON_WIDTH = 130
+
+    def buttons_for(self, order, downloading, progress=None):
+        if order['status'] == 'received':
+            if progress is not None:
+                download_text = f"Загрузка {progress}%"
+            else:
+                download_text = "Загрузка..." if downloading else "Файл"
+            return [
+                ('info', "Информация", True),
+                ('download', download_text, not downloading),
+                ('ready', "Готово", True),
+            ]
+        return [
+            ('code', "Код выдачи", True),
+            ('complete', "Выдать", True),
+        ]
+
+    def button_rects(self, rect, count):
+        rects = []
+        x = rect.left() + self.MARGIN_X
+        for _ in range(count):
+            rects.append(QRect(x, rect.top() + self.MARGIN_Y, self.BUTTON_WIDTH, rect.height() - 2 * self.MARGIN_Y))
+            x += self.BUTTON_WIDTH + self.SPACING
+        return rects
+
+    def sizeHint(self, option, index):
+        return QSize(option.rect.width(), self.ROW_HEIGHT)
+
+    def paint(self, painter, option, index):
+        order = index.data(OrderListModel.OrderRole)
+        downloading = index.data(OrderListModel.DownloadingRole)
+        buttons = self.buttons_for(order, downloading, index.data(OrderListModel.ProgressRole))
+        rects = self.button_rects(option.rect, len(buttons))
+        style = option.widget.style() if option.widget else QApplication.style()
+
+        painter.save()
+        painter.setPen(QPen(QColor("#eeeeee")))
+        painter.drawLine(option.rect.bottomLeft(), option.rect.bottomRight())
+
+        for (action, text, enabled), rect in zip(buttons, rects):
+            button = QStyleOptionButton()
+            button.rect = rect
+            button.text = text
+            button.state = QStyle.StateFlag.State_Raised
+            if enabled:
+                button.state |= QStyle.StateFlag.State_Enabled
+            style.drawControl(QStyle.ControlElement.CE_PushButton, button, painter, option.widget)
+
+        text_left = rects[-1].right() + self.SPACING + 5
+        text_rect = QRect(text_left, option.rect.top(), option.rect.right() - text_left - 5, option.rect.height())
+        font = QFont(option.font)
+        font.setWeight(QFont.Weight.DemiBold)
+        painter.setFont(font)
+        painter.setPen(QColor("#dc3545" if order['status'] == 'received' else "#28a745"))
+        painter.drawText(
+            text_rect,
+            Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft | Qt.TextFlag.TextWordWrap,
+            index.data(Qt.ItemDataRole.DisplayRole)
+        )
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() != QEvent.Type.MouseButtonRelease or event.button() != Qt.MouseButton.LeftButton:
+            return False
+        order = index.data(OrderListModel.OrderRole)
+        buttons = self.buttons_for(order, index.data(OrderListModel.DownloadingRole))
+        for (action, text, enabled), rect in zip(buttons, self.button_rects(option.rect, len(buttons))):
+            if enabled and rect.contains(event.position().toPoint()):
+                self.buttonClicked.emit(action, order)
+                return True
+        return False
+
+
 class FileReceiverApp(QWidget):
     def __init__(self, auth_manager: AuthManager):
         super().__init__()
         self.auth_manager = auth_manager
         self.shop_info = auth_manager.shop_info
         self.is_refreshing = False
-        self.file_cache = set()
-        self.current_items = {}
+        self.order_model = OrderListModel()
+        self.orders = {}
+        self.orders_cursor = None
+        self.orders_loading = False  # синхронизация списка уже идет
+        self.orders_reload_requested = False  # во время синхронизации запрошена еще одна
+        self.feed_connected = False
+        self.feed_cursor = None
+        self.feed_epoch = None  # запуск сервера, в котором выдан feed_cursor
+        self.feed_task = None
 
         if not self.shop_info:
             logging.error("shop_info is None in FileReceiverApp constructor!")
@@ -240,7 +497,9 @@ class FileReceiverApp(QWidget):
         self.setup_timers()
 
         self.current_downloads = {}
-        self.load_existing_files()
+        self.active_downloads = {}  # имя файла -> задача загрузки
+        self.download_validators = {}
+        self.prefetcher = FilePrefetcher(self.download_file, PREFETCH_CONCURRENCY, PREFETCH_DISK_BUDGET)
 
     def init_ui(self):
         self.setStyleSheet("""
@@ -253,7 +512,7 @@ class FileReceiverApp(QWidget):
             QPushButton {
                 font-size: 13px;
             }
-            QListWidget {
+            QListView {
                 font-size: 14px;
             }
         """)
@@ -286,6 +545,20 @@ class FileReceiverApp(QWidget):
         """)
         top_panel.addWidget(self.shop_label)
 
+        self.color_filter = QComboBox()
+        self.color_filter.addItem("Все типы печати", None)
+        self.color_filter.addItem("Черно-белая", "черно-белая")
+        self.color_filter.addItem("Цветная", "цветная")
+        self.color_filter.addItem("Смешанная", "смешанная")
+        self.color_filter.currentIndexChanged.connect(self.on_filters_changed)
+        top_panel.addWidget(self.color_filter)
+
+        self.sort_order = QComboBox()
+        self.sort_order.addItem("Сначала старые", Qt.SortOrder.AscendingOrder)
+        self.sort_order.addItem("Сначала новые", Qt.SortOrder.DescendingOrder)
+        self.sort_order.currentIndexChanged.connect(self.on_filters_changed)
+        top_panel.addWidget(self.sort_order)
+
         # Растягивающийся элемент
         top_panel.addSpacerItem(QSpacerItem(40, 20, QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum))
 
@@ -308,19 +581,28 @@ class FileReceiverApp(QWidget):
         self.menu_btn.setMenu(menu)
         top_panel.addWidget(self.menu_btn)
 
-        self.received_list = QListWidget()
-        self.ready_list = QListWidget()
-
-        for lst in [self.received_list, self.ready_list]:
+        self.order_delegate = OrderItemDelegate(self)
+        self.order_delegate.buttonClicked.connect(self.on_order_button_clicked)
+
+        self.received_proxy = OrderFilterProxyModel('received', self)
+        self.ready_proxy = OrderFilterProxyModel('ready', self)
+        self.received_list = QListView()
+        self.ready_list = QListView()
+
+        for lst, proxy in [(self.received_list, self.received_proxy), (self.ready_list, self.ready_proxy)]:
+            proxy.setSourceModel(self.order_model)
+            proxy.sort(0, Qt.SortOrder.AscendingOrder)
+            lst.setModel(proxy)
+            lst.setItemDelegate(self.order_delegate)
+            # Одинаковая высота строк - представление не измеряет строки вне экрана
+            lst.setUniformItemSizes(True)
+            lst.setSelectionMode(QListView.SelectionMode.NoSelection)
             lst.setStyleSheet("""
-                QListWidget {
+                QListView {
                     background-color: #ffffff;
                     border: 1px solid #cccccc;
                     border-radius: 4px;
                 }
-                QListWidget::item {
-                    border-bottom: 1px solid #eeeeee;
-                }
             """)
 
         main_layout.addLayout(top_panel)
@@ -399,20 +681,91 @@ class FileReceiverApp(QWidget):
 
     def setup_timers(self):
         self.timer = QTimer()
-        self.timer.timeout.connect(self.on_timer_timeout)
-        self.timer.start(350000)  # 5 минут
+        self.timer.timeout.connect(self.on_poll_timeout)
+        self.timer.start(POLL_INTERVAL_MS)
+
+        # Схлопываем пачку событий из потока в одно обновление списка
+        self.feed_refresh_timer = QTimer()
+        self.feed_refresh_timer.setSingleShot(True)
+        self.feed_refresh_timer.setInterval(300)
+        self.feed_refresh_timer.timeout.connect(self.on_timer_timeout)
+
         # Запускаем первоначальную загрузку через QTimer
         QTimer.singleShot(0, lambda: asyncio.ensure_future(self.load_orders()))
+        QTimer.singleShot(0, self.start_order_feed)
 
     @asyncSlot()
     async def on_timer_timeout(self):
         await self.load_orders()
 
+    def on_poll_timeout(self):
+        # Пока поток событий подключен, опрашивать сервер не нужно
+        if not self.feed_connected:
+            self.on_timer_timeout()
+
+    def start_order_feed(self):
+        if self.feed_task is None or self.feed_task.done():
+            self.feed_task = asyncio.ensure_future(self.run_order_feed())
+
+    async def run_order_feed(self):
+        """Подключение к потоку событий /ws/orders с переподключением и курсором"""
+        delay = FEED_RECONNECT_MIN_DELAY
+        while True:
+            try:
+                if aiohttp_session is None or aiohttp_session.closed:
+                    await init_aiohttp_session()
+
+                params = {}
+                if self.feed_cursor is not None:
+                    params['since'] = self.feed_cursor
+                    params['epoch'] = self.feed_epoch
+
+                async with aiohttp_session.ws_connect(
+                    f"{API_URL}/ws/orders",
+                    params=params,
+                    headers={'Authorization': f'Bearer {self.auth_manager.access_token}'},
+                    heartbeat=60
+                ) as ws:
+                    logging.info("Order feed connected")
+                    self.feed_connected = True
+                    delay = FEED_RECONNECT_MIN_DELAY
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        self.handle_feed_event(json.loads(msg.data))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Order feed error: {str(e)}")
+            finally:
+                self.feed_connected = False
+
+            logging.info(f"Order feed disconnected, reconnecting in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, FEED_RECONNECT_MAX_DELAY)
+
+    def handle_feed_event(self, event: dict):
+        event_type = event.get('type')
+        if event_type in ('hello', 'resync'):
+            # Номер и запуск от сервера авторитетны, в том числе после его перезапуска
+            self.feed_cursor = event['seq']
+            self.feed_epoch = event.get('epoch')
+        elif 'seq' in event:
+            self.feed_cursor = max(self.feed_cursor or 0, event['seq'])
+
+        if event_type == 'hello':
+            # На каждом подключении сверяемся дельтой: события, созданные пока соединения
+            # не было, могли не попасть в буфер сервера
+            self.feed_refresh_timer.start()
+        elif event_type in ('order_created', 'order_status_changed', 'resync'):
+            logging.info(f"Order feed event: {event}")
+            self.feed_refresh_timer.start()
+
     @asyncSlot()
     async def handle_download_or_open(self, order):
         """Обработчик загрузки или открытия файла через прокси"""
         order_id = order['ID']
-        filename = order['file_path']
+        filename = local_filename(order)
         filepath = os.path.join(DOWNLOAD_DIR, filename)
 
         # Если файл уже существует, просто открываем папку
@@ -421,15 +774,15 @@ class FileReceiverApp(QWidget):
             return
 
         # Прямая загрузка файла с сервера через защищенный эндпоинт
-        file_url = f"{API_URL}/files/{filename}"
+        file_url = f"{API_URL}/files/{order['file_path']}"
 
         # Блокируем кнопку для этого заказа
         self.current_downloads[order_id] = True
-        await self.load_orders()  # Обновляем список
+        self.update_download_button(order_id)
 
         try:
-            # Скачиваем файл напрямую через прокси
-            success = await self.download_file(file_url, filename)
+            # Если файл уже скачивается в фоне, download_file дождется этой загрузки
+            success = await self.download_file(file_url, filename, order_id=order_id)
 
             if success:
                 # Открываем папку downloads после загрузки
@@ -442,66 +795,136 @@ class FileReceiverApp(QWidget):
             # Разблокируем кнопку
             if order_id in self.current_downloads:
                 del self.current_downloads[order_id]
-            await self.load_orders()  # Обновляем список
+            self.update_download_button(order_id)
 
-    async def download_file(self, url: str, filename: str) -> bool:
-        """Скачивание файла с поддержкой JWT токена и прокси"""
+    async def download_file(self, url: str, filename: str, show_errors: bool = True, order_id=None) -> bool:
+        """
+        Скачивание файла в DOWNLOAD_DIR. Одновременные загрузки в один файл (фоновая и по кнопке)
+        объединяются: вторая дожидается первой, а не пишет в тот же .part
+        """
+        if os.path.exists(os.path.join(DOWNLOAD_DIR, filename)):
+            return True
+        task = self.active_downloads.get(filename)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch_file(url, filename, show_errors, order_id))
+            self.active_downloads[filename] = task
+            task.add_done_callback(lambda _: self.active_downloads.pop(filename, None))
+        return await asyncio.shield(task)
+
+    async def fetch_file(self, url: str, filename: str, show_errors: bool = True, order_id=None) -> bool:
+        """Потоковое скачивание файла с докачкой после обрыва, поддержкой JWT токена и прокси"""
+        filepath = os.path.join(DOWNLOAD_DIR, filename)
         try:
-            filepath = os.path.join(DOWNLOAD_DIR, filename)
-
-            # Добавляем заголовок авторизации для защищенного эндпоинта
-            headers = {}
-            if self.auth_manager.access_token:
-                headers['Authorization'] = f'Bearer {self.auth_manager.access_token}'
-
-            # Используем нашу функцию с поддержкой прокси
-            response = await make_aiohttp_request(
-                'GET',
-                url,
-                headers=headers
-            )
-
-            if response.status == 200:
-                content = await response.read()
-                async with aiofiles.open(filepath, 'wb') as f:
-                    await f.write(content)
-                return True
-            else:
-                logging.error(f"Download failed with status: {response.status}")
-                return False
-        except aiohttp.ClientProxyConnectionError as e:
-            logging.error(f"Proxy connection error during download: {str(e)}")
-            self.show_error(f"Ошибка подключения через прокси: {str(e)}")
+            for attempt in range(DOWNLOAD_RETRIES):
+                try:
+                    result = await self.download_attempt(url, filepath, order_id)
+                    if result is not None:
+                        return result
+                except aiohttp.ClientProxyConnectionError as e:
+                    logging.error(f"Proxy connection error during download: {str(e)}")
+                    if show_errors:
+                        self.show_error(f"Ошибка подключения через прокси: {str(e)}")
+                    return False
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.warning(f"Download of {filename} interrupted "
+                                    f"(attempt {attempt + 1}/{DOWNLOAD_RETRIES}): {str(e)}")
+                    await asyncio.sleep(min(2 ** attempt, 10))
             return False
         except Exception as e:
             logging.error(f"Download error: {str(e)}")
             traceback.print_exc()
             return False
+        finally:
+            if order_id is not None:
+                self.order_model.set_download_progress(order_id, None)
+
+    async def download_attempt(self, url: str, filepath: str, order_id=None) -> Optional[bool]:
+        """
+        Одна попытка загрузки в файл .part, продолжая с уже скачанного места через Range.
+        Возвращает True/False как итог или None, если нужно повторить попытку.
+        """
+        temp_path = filepath + '.part'
+
+        # Добавляем заголовок авторизации для защищенного эндпоинта
+        headers = {}
+        if self.auth_manager.access_token:
+            headers['Authorization'] = f'Bearer {self.auth_manager.access_token}'
+
+        offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+        validator = self.download_validators.get(filepath)
+        if offset and validator:
+            headers['Range'] = f'bytes={offset}-'
+            # Если файл на сервере изменился, сервер вернет его целиком
+            headers['If-Range'] = validator
+        else:
+            offset = 0
+
+        # Используем нашу функцию с поддержкой прокси
+        response = await make_aiohttp_request(
+            'GET',
+            url,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        )
+        try:
+            if response.status == 416:
+                # Сохраненная часть не соответствует файлу на сервере - начинаем заново
+                os.remove(temp_path)
+                self.download_validators.pop(filepath, None)
+                return None
+            if response.status == 206:
+                mode = 'ab'
+                total = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            elif response.status == 200:
+                mode, offset = 'wb', 0
+                total = response.content_length
+            else:
+                logging.error(f"Download failed with status: {response.status}")
+                return False
+
+            # Сильный ETag (хеш содержимого) надежнее даты изменения
+            etag = response.headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                self.download_validators[filepath] = etag
+            else:
+                self.download_validators[filepath] = response.headers.get('Last-Modified')
+            received = offset
+            last_percent = None
+            async with aiofiles.open(temp_path, mode) as f:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+                    received += len(chunk)
+                    if order_id is not None and total:
+                        percent = received * 100 // total
+                        if percent != last_percent:
+                            last_percent = percent
+                            self.order_model.set_download_progress(order_id, percent)
+
+            if total is not None and received != total:
+                raise aiohttp.ClientPayloadError(f"Received {received} of {total} bytes")
+
+            # Файл появляется под своим именем только целиком
+            os.replace(temp_path, filepath)
+            self.download_validators.pop(filepath, None)
+            return True
+        finally:
+            response.release()
 
     def validate_order(self, order):
         required_fields = ['ID', 'status', 'file_path']
         return all(field in order for field in required_fields)
 
-    def load_existing_files(self):
-        pass
-
-    @asyncSlot()
-    async def load_orders(self):
+    async def fetch_orders(self, params: dict) -> Optional[dict]:
+        """Один запрос GET /orders в режиме дельты. None - ошибка (уже показана пользователю)"""
+        resp = await self.auth_manager.make_authenticated_request(
+            'GET',
+            f"{API_URL}/orders",
+            params={'status': ['received', 'ready'], **params}
+        )
         try:
-            logging.info("Loading orders through proxy...")
-
-            resp = await self.auth_manager.make_authenticated_request(
-                'GET',
-                f"{API_URL}/orders",
-                params={'status': ['received', 'ready']}
-            )
-
             if resp.status == 200:
                 # Читаем JSON только если статус успешный
-                orders = await resp.json()
-                logging.info(f"Loaded {len(orders)} orders")
-                unique_orders = {order['ID']: order for order in orders}.values()
-                self.handle_orders(list(unique_orders))
+                return await resp.json()
             elif resp.status == 401:
                 logging.warning("Session expired - received 401 from server")
                 self.show_error("Сессия истекла. Пожалуйста, перезайдите.")
@@ -510,9 +933,61 @@ class FileReceiverApp(QWidget):
                 error_text = await resp.text()
                 logging.error(f"Failed to load orders: {resp.status}, {error_text}")
                 self.show_error(f"Ошибка загрузки заказов: {resp.status}")
-
+            return None
+        finally:
             await resp.release()
 
+    @asyncSlot()
+    async def load_orders(self):
+        """
+        Синхронизация списка заказов. Одновременно идет только одна: очистка списка и курсор
+        одной загрузки не должны смешиваться со страницами другой. Запросы во время загрузки
+        схлопываются в один повтор после нее.
+        """
+        if self.orders_loading:
+            self.orders_reload_requested = True
+            return
+
+        self.orders_loading = True
+        try:
+            while True:
+                self.orders_reload_requested = False
+                await self.sync_orders()
+                if not self.orders_reload_requested:
+                    break
+        finally:
+            self.orders_loading = False
+
+    async def sync_orders(self):
+        try:
+            logging.info("Loading orders through proxy...")
+
+            initial = self.orders_cursor is None
+            data = await self.fetch_orders({'since': self.orders_cursor or '0'})
+            if data is not None and data.get('reset'):
+                # Изменений накопилось больше, чем сервер отдает за раз - загружаем список заново
+                logging.info("Orders delta is too large, reloading")
+                initial = True
+                data = await self.fetch_orders({'since': '0'})
+            if data is None:
+                return
+
+            # При начальной загрузке курсор берется с первой страницы: изменения,
+            # сделанные во время загрузки остальных страниц, придут следующей дельтой
+            cursor = data['cursor']
+            if initial:
+                self.orders.clear()
+            changed = self.apply_orders_delta(data)
+            while data.get('next_after') is not None:
+                data = await self.fetch_orders({'since': '0', 'after': data['next_after']})
+                if data is None:
+                    return
+                changed = self.apply_orders_delta(data) or changed
+
+            if changed or initial:
+                self.handle_orders(list(self.orders.values()))
+            self.orders_cursor = cursor
+
         except aiohttp.ClientProxyConnectionError as e:
             logging.error(f"Proxy connection error: {str(e)}")
             self.show_error(f"Ошибка подключения через прокси:\n{str(e)}\n\nПроверьте настройки прокси.")
@@ -520,88 +995,55 @@ class FileReceiverApp(QWidget):
             logging.error(f"Load orders error: {str(e)}\n{traceback.format_exc()}")
             self.show_error(f"Ошибка запроса: {str(e)}")
 
+    def apply_orders_delta(self, data: dict) -> bool:
+        """Применяет дельту из GET /orders к локальному списку, возвращает True при изменениях"""
+        changed = False
+        for order in data['orders']:
+            if self.orders.get(order['ID']) != order:
+                self.orders[order['ID']] = order
+                changed = True
+        for order_id in data['removed']:
+            if self.orders.pop(order_id, None) is not None:
+                changed = True
+        logging.info(f"Orders delta: {len(data['orders'])} changed, {len(data['removed'])} removed")
+        return changed
+
     def handle_orders(self, orders):
         try:
-            self.received_list.clear()
-            self.ready_list.clear()
-            self.current_items.clear()
-
-            for order in orders:
-                if not self.validate_order(order):
-                    continue
-
-                item = QListWidgetItem()
-                widget = self.create_order_widget(order)
-                item.setSizeHint(widget.sizeHint())
-
-                target_list = self.received_list if order['status'] == 'received' else self.ready_list
-                target_list.addItem(item)
-                target_list.setItemWidget(item, widget)
-                self.current_items[order['ID']] = (item, widget)
-
-            logging.info(f"Displayed {len(orders)} orders")
+            valid_orders = [order for order in orders if self.validate_order(order)]
+            self.order_model.set_orders(valid_orders)
+            self.prefetcher.schedule(valid_orders)
+            logging.info(f"Displayed {self.order_model.rowCount()} orders")
         except Exception as e:
             logging.error(f"Handle orders error: {str(e)}\n{traceback.format_exc()}")
 
-    def create_order_widget(self, order):
-        widget = QWidget()
-        layout = QHBoxLayout()
-        layout.setContentsMargins(10, 5, 10, 5)
-        layout.setSpacing(10)
-
-        file_name = os.path.basename(order['file_path'])
-        label_text = f"Заказ №{order['ID']}: {file_name}"
-        label = QLabel(label_text)
-        label.setWordWrap(True)
-        color = "#dc3545" if order['status'] == 'received' else "#28a745"
-        label.setStyleSheet(f"QLabel {{ color: {color}; font-weight: 600; font-size: 13px; padding: 5px; }}")
-
-        buttons = []
-        if order['status'] == 'received':
-            btn_download = QPushButton("Файл")
-            if order['ID'] in self.current_downloads:
-                btn_download.setEnabled(False)
-                btn_download.setText("Загрузка...")
-            else:
-                btn_download.clicked.connect(lambda: self.handle_download_or_open(order))
-
-            btn_ready = QPushButton("Готово")
-            btn_ready.clicked.connect(lambda: self.confirm_status_change(
+    def update_download_button(self, order_id):
+        self.order_model.set_downloading(order_id, order_id in self.current_downloads)
+
+    def on_filters_changed(self):
+        color = self.color_filter.currentData()
+        sort_order = self.sort_order.currentData()
+        for proxy in (self.received_proxy, self.ready_proxy):
+            proxy.set_color_filter(color)
+            proxy.sort(0, sort_order)
+
+    def on_order_button_clicked(self, action, order):
+        if action == 'info':
+            self.show_order_info(order)
+        elif action == 'download':
+            self.handle_download_or_open(order)
+        elif action == 'ready':
+            self.confirm_status_change(
                 order['ID'], 'ready',
                 f"Подтвердите изменение статуса заказа №{order['ID']} на 'Готово'"
-            ))
-            btn_info = QPushButton("Информация")
-            btn_info.clicked.connect(lambda: self.show_order_info(order))
-            buttons = [btn_info, btn_download, btn_ready]
-        else:
-            btn_complete = QPushButton("Выдать")
-            btn_complete.clicked.connect(lambda: self.confirm_status_change(
+            )
+        elif action == 'complete':
+            self.confirm_status_change(
                 order['ID'], 'completed',
                 f"Подтвердите выдачу заказа №{order['ID']} клиенту"
-            ))
-            btn_info = QPushButton("Код выдачи")
-            btn_info.clicked.connect(lambda: self.show_con_code(order))
-            buttons = [btn_info, btn_complete]
-
-        button_style = """
-            QPushButton {
-                background-color: #f8f9fa;
-                border: 1px solid #dee2e6;
-                border-radius: 4px;
-                padding: 6px 12px;
-                min-width: 120px;
-            }
-            QPushButton:hover {
-                background-color: #e2e6ea;
-            }
-        """
-        for btn in buttons:
-            btn.setStyleSheet(button_style)
-            layout.addWidget(btn)
-
-        layout.addWidget(label)
-        widget.setLayout(layout)
-        return widget
+            )
+        elif action == 'code':
+            self.show_con_code(order)
 
     def open_downloads_folder(self):
         if sys.platform == "win32":
@@ -621,7 +1063,10 @@ class FileReceiverApp(QWidget):
             QTimer.singleShot(0, lambda: asyncio.ensure_future(self.update_status(order_id, new_status)))
 
     def show_order_info(self, order):
-        info_message = f"Заказ №{order['ID']}\nТип печати: {order['color']}\nКомментарий: {order.get('note', 'Нет информации')}\nСтоимость печати: {order['price']} руб."
+        info_message = f"Заказ №{order['ID']}\nТип печати: {order['color']}\n"
+        if order.get('color_page_list'):
+            info_message += f"Цветные страницы ({order.get('color_pages')}): {order['color_page_list']}\n"
+        info_message += f"Комментарий: {order.get('note', 'Нет информации')}\nСтоимость печати: {order['price']} руб."
         QMessageBox.information(self, "Информация о заказе", info_message)
 
     def show_con_code(self, order):
@@ -650,6 +1095,11 @@ class FileReceiverApp(QWidget):
         QMessageBox.critical(self, "Ошибка", message)
 
     def closeEvent(self, event):
+        if self.feed_task is not None:
+            self.feed_task.cancel()
+        self.prefetcher.cancel_all()
+        for task in list(self.active_downloads.values()):
+            task.cancel()
         logging.info("Closing application, cleaning up downloads...")
         if os.path.exists(DOWNLOAD_DIR):
             for filename in os.listdir(DOWNLOAD_DIR):